@@ -1,10 +1,11 @@
 from typing import Union
 import numpy as np
 from scipy.interpolate import CubicSpline
+from scipy.spatial import cKDTree
 
 
 class FrenetConverter:
-    def __init__(self, waypoints_x: np.array, waypoints_y: np.array, waypoints_psi: np.array = None):
+    def __init__(self, waypoints_x: np.array, waypoints_y: np.array, waypoints_psi: np.array = None, lut_resolution_m: float = 0.02):
         self.waypoints_x = waypoints_x
         self.waypoints_y = waypoints_y
         #TODO: Adding psi to constructor with default None to not break existing calls, but it is not the nicest
@@ -13,23 +14,59 @@ class FrenetConverter:
         self.spline_x = None
         self.spline_y = None
         self.raceline_length = None
+        self.waypoints_tree = None
         self.waypoints_distance_m = 0.1 # [m]
-        self.iter_max = 3
+        # spacing of the lookup tables, the position error of the linear interpolation is about curvature*res^2/8
+        self.lut_resolution_m = lut_resolution_m # [m]
+        self.lut_s = None
+        self.iter_max = 10 # maximum Newton iterations of get_frenet_coord
 
         self.build_raceline()
 
     def build_raceline(self):
-        self.waypoints_s = [0.0]
-        prev_wpnt_x =  self.waypoints_x[0]
-        prev_wpnt_y =  self.waypoints_y[0]
-        for wpnt_x, wpnt_y in zip(self.waypoints_x[1:], self.waypoints_y[1:]):
-            dist = np.linalg.norm([wpnt_x - prev_wpnt_x, wpnt_y - prev_wpnt_y])
-            prev_wpnt_x = wpnt_x
-            prev_wpnt_y = wpnt_y
-            self.waypoints_s.append(self.waypoints_s[-1] + dist)        
+        steps = np.hypot(np.diff(self.waypoints_x), np.diff(self.waypoints_y))
+        self.waypoints_s = np.concatenate([[0.0], np.cumsum(steps)])
         self.spline_x = CubicSpline(self.waypoints_s, self.waypoints_x)
         self.spline_y = CubicSpline(self.waypoints_s, self.waypoints_y)
         self.raceline_length = self.waypoints_s[-1]
+        self.build_lookup_tables()
+        # spatial index for nearest waypoint queries
+        self.waypoints_tree = cKDTree(np.column_stack([self.waypoints_x, self.waypoints_y]))
+
+    def build_lookup_tables(self):
+        """
+        Evaluates the splines once on a uniform s grid over one lap, queries then only interpolate
+        linearly between the two closest entries.
+        """
+        n = max(int(np.ceil(self.raceline_length/self.lut_resolution_m)), 1)
+        self.lut_s = np.linspace(0.0, self.raceline_length, n + 1)
+        self.lut_step = self.raceline_length/n
+        self.lut_x = self.spline_x(self.lut_s)
+        self.lut_y = self.spline_y(self.lut_s)
+        self.lut_dx = self.spline_x(self.lut_s, 1)
+        self.lut_dy = self.spline_y(self.lut_s, 1)
+        norm = np.hypot(self.lut_dx, self.lut_dy)
+        # unit tangent [tx, ty], the unit normal pointing to positive d is [-ty, tx]
+        self.lut_tx = self.lut_dx/norm
+        self.lut_ty = self.lut_dy/norm
+        # signed curvature, positive when turning towards positive d
+        ddx = self.spline_x(self.lut_s, 2)
+        ddy = self.spline_y(self.lut_s, 2)
+        self.lut_kappa = (self.lut_dx*ddy - self.lut_dy*ddx)/norm**3
+        # unwrapped, so that neighbouring entries can be interpolated
+        self.lut_psi = np.unwrap(np.arctan2(self.lut_dy, self.lut_dx))
+
+    def interpolate_lut(self, s, *tables) -> list:
+        """
+        Linear interpolation of the lookup tables at s, which is wrapped to one lap.
+        Non-finite s give NaN.
+        """
+        s = np.asarray(s, dtype=float)
+        finite = np.isfinite(s)
+        pos = (np.where(finite, s, 0.0) % self.raceline_length)/self.lut_step
+        idx = np.minimum(pos.astype(int), len(self.lut_s) - 2)
+        frac = np.where(finite, pos - idx, np.nan)
+        return [table[idx]*(1 - frac) + table[idx + 1]*frac for table in tables]
 
     def get_frenet(self, x, y, s=None) -> np.array:
         # Compute Frenet coordinates for a given (x, y) point
@@ -41,15 +78,118 @@ class FrenetConverter:
 
         return np.array([s, d])
 
+    def get_frenet_sequence(self, x, y, jump_m=1.0, margin_m=1.0, anchor_m=0.5) -> np.array:
+        """
+        Computes the Frenet coordinates of consecutive samples of one trajectory.
+
+        Anchor samples, about every anchor_m travelled, take their global nearest waypoint unless
+        it is further from the previous anchor's than the distance moved plus margin_m allows,
+        in which case they are tracked in a window around the previous anchor's. Every sample is
+        then only searched in a window around its anchor's nearest waypoint, as wide as its own
+        distance to the anchor plus margin_m. The windows wrap around the end of the lap. The
+        search falls back to the global nearest waypoint after steps longer than jump_m, or when
+        that is more than jump_m closer than the tracked one.
+
+        It is about as fast as get_frenet, whose KD-tree search is already cheap. Use it for
+        robustness: where other parts of the raceline are close, e.g. the two straights of a
+        hairpin, the nearest waypoint of get_frenet can hop to the wrong one, while the tracked
+        window stays on the part driven along.
+
+        Args:
+            x (np.array): x-coordinates of the samples, in temporal order
+            y (np.array): y-coordinates of the samples, in temporal order
+            jump_m (float): step length [m] treated as a jump. Default is 1.0.
+            margin_m (float): search distance [m] on top of the distance moved. Default is 1.0.
+            anchor_m (float): distance [m] travelled between anchors. Default is 0.5.
+
+        Returns:
+            np.array: [s, d] Frenet coordinates
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if len(x) == 0:
+            return np.zeros((2, 0))
+        n_wpnts = len(self.waypoints_x)
+        steps = np.hypot(np.diff(x), np.diff(y))
+        jumps = np.concatenate([[True], steps > jump_m])
+        travel = np.concatenate([[0.0], np.cumsum(steps)])
+        anchors = np.flatnonzero(jumps | np.concatenate([[True], np.diff(np.floor(travel/anchor_m)) > 0]))
+
+        # global nearest waypoints of the anchors, tracked where they jump against the previous anchor
+        anchor_dist, anchor_idx = self.waypoints_tree.query(np.column_stack([x[anchors], y[anchors]]))
+        moved = np.hypot(np.diff(x[anchors]), np.diff(y[anchors]))
+        allowed = np.concatenate([[0], np.ceil((moved + margin_m)/self.waypoints_distance_m)]).astype(int)
+        tracked = ~jumps[anchors]
+
+        def inconsistent(j):
+            delta = (anchor_idx[j] - anchor_idx[j - 1] + n_wpnts//2) % n_wpnts - n_wpnts//2
+            return tracked[j] & (np.abs(delta) > allowed[j])
+
+        candidates = np.flatnonzero(inconsistent(np.arange(1, len(anchors)))) + 1
+        j = candidates[0] if len(candidates) > 0 else len(anchors)
+        while j < len(anchors):
+            rows = anchors[j:j + 1]
+            idx, dist = self.get_nearest_around(x[rows], y[rows], anchor_idx[j - 1:j], allowed[j:j + 1])
+            if np.sqrt(dist[0]) <= anchor_dist[j] + jump_m:
+                anchor_idx[j] = idx[0]
+                anchor_dist[j] = np.sqrt(dist[0])
+            # the next anchor is checked again against the tracked one
+            if j + 1 < len(anchors) and inconsistent(j + 1):
+                j += 1
+            else:
+                k = np.searchsorted(candidates, j + 2)
+                j = candidates[k] if k < len(candidates) else len(anchors)
+
+        # every other sample around its anchor, at most anchor_m + margin_m away
+        idx = np.empty(len(x), dtype=int)
+        idx[anchors] = anchor_idx
+        rest = np.flatnonzero(np.isin(np.arange(len(x)), anchors, invert=True))
+        if len(rest) > 0:
+            owner = anchors[np.searchsorted(anchors, rest) - 1]
+            moved = np.hypot(x[rest] - x[owner], y[rest] - y[owner])
+            bound = np.ceil((moved + margin_m)/self.waypoints_distance_m).astype(int)
+            idx[rest], _ = self.get_nearest_around(x[rest], y[rest], idx[owner], bound)
+
+        s, d = self.get_frenet_coord(x, y, idx*self.waypoints_distance_m)
+        return np.array([s, d])
+
+    def get_nearest_around(self, x, y, seed, bound, chunk=2048) -> tuple:
+        """
+        Finds the nearest waypoint of every point among those at most bound waypoints away from
+        its seed waypoint, wrapping around the end of the lap. The points are processed in chunks
+        of rows, each against a window as wide as its largest bound.
+
+        Returns:
+            The waypoint indices and squared distances.
+        """
+        n_wpnts = len(self.waypoints_x)
+        width = int(min(np.max(bound), n_wpnts//2))
+        # waypoints padded by the window on both ends, so every window is a contiguous view
+        padded_x = np.concatenate([self.waypoints_x[n_wpnts - width:], self.waypoints_x, self.waypoints_x[:width]])
+        padded_y = np.concatenate([self.waypoints_y[n_wpnts - width:], self.waypoints_y, self.waypoints_y[:width]])
+        windows_x = np.lib.stride_tricks.sliding_window_view(padded_x, 2*width + 1)
+        windows_y = np.lib.stride_tricks.sliding_window_view(padded_y, 2*width + 1)
+        offsets = np.abs(np.arange(-width, width + 1))
+
+        idx = np.empty(len(x), dtype=int)
+        dist = np.empty(len(x))
+        for start in range(0, len(x), chunk):
+            rows = slice(start, start + chunk)
+            chunk_dist = (windows_x[seed[rows]] - x[rows, None])**2 + (windows_y[seed[rows]] - y[rows, None])**2
+            chunk_dist[offsets > bound[rows, None]] = np.inf
+            best = np.argmin(chunk_dist, axis=1)
+            idx[rows] = (seed[rows] + best - width) % n_wpnts
+            dist[rows] = chunk_dist[np.arange(len(best)), best]
+        return idx, dist
+
     def get_approx_s(self, x, y) -> float:
         """
         Finds the s-coordinate of the given point by finding the nearest waypoint.
         """
-        # get distance with broadcasting multiple arrays
-        lenx = len(x)
-        dist_x = x - np.tile(self.waypoints_x, (lenx, 1)).T
-        dist_y = y - np.tile(self.waypoints_y, (lenx, 1)).T
-        return np.argmin(np.linalg.norm([dist_x.T, dist_y.T], axis=0), axis=1)*self.waypoints_distance_m
+        # O(log N) per point on the KD-tree, without any (waypoints x points) temporaries
+        points = np.column_stack([np.atleast_1d(x), np.atleast_1d(y)])
+        _, idx = self.waypoints_tree.query(points)
+        return idx*self.waypoints_distance_m
 
     def get_frenet_velocities(self, vx: float, vy: float, theta: float, s: float) -> np.array:
         """
@@ -73,53 +213,82 @@ class FrenetConverter:
         
         return np.array([s_dot, d_dot])
 
-    def get_frenet_coord(self, x, y, s, eps_m=0.01) -> float:
+    def get_frenet_coord(self, x, y, s, eps_m=0.01, return_residuals=False) -> tuple:
         """
         Finds the s-coordinate of the given point, considering the perpendicular
         projection of the point on the track.
-        
+
+        Newton iterations on the projection proj(s) of the point on the tangent, whose
+        derivative is -(1 - curvature*d). Points leave the active set once |proj| <= eps_m,
+        so later iterations only evaluate the track at the points that did not converge yet.
+        Converged points still take their last Newton step, which needs no evaluation and
+        makes the error in s quadratic in eps_m. At most iter_max iterations are run.
+
         Args:
             x (float): x-coordinate of the point
             y (float): y-coordinate of the point
             s (float): estimated s-coordinate of the point
             eps_m (float): maximum error tolerance for the projection. Default is 0.01.
-        
+            return_residuals (bool): also return |proj| of the last evaluation, points with a
+                residual above eps_m did not converge. Default is False.
+
         Returns:
-            The s-coordinate of the point on the track.
+            The s-coordinate and d-coordinate (and residual) of the point on the track.
         """
-        # Check if point is on the estimated s perpendicular to the track
+        shape = np.shape(s)
+        x = np.broadcast_to(x, shape).ravel().astype(float)
+        y = np.broadcast_to(y, shape).ravel().astype(float)
+        s = np.ravel(s).astype(float) % self.raceline_length
+        d = np.zeros_like(s)
+        residuals = np.zeros_like(s)
 
-        _, projection, d = self.check_perpendicular(x, y, s, eps_m)
-        for i in range(self.iter_max):
-            cand_s = (s + projection)%self.raceline_length
-            _, cand_projection, cand_d = self.check_perpendicular(x, y, cand_s, eps_m)
-            #print(f"candidate projection: {cand_projection}; projection: {projection}; d: {d} cand_d: {cand_d}")
-            cand_projection = np.clip(cand_projection, -self.waypoints_distance_m/(2*self.iter_max), self.waypoints_distance_m/(2*self.iter_max))
-            updated_idxs = np.abs(cand_projection) <= np.abs(projection)
-            d[updated_idxs] = cand_d[updated_idxs]
-            s[updated_idxs] = cand_s[updated_idxs]
-            projection[updated_idxs] = cand_projection[updated_idxs]
+        active = np.arange(len(s))
+        for i in range(self.iter_max + 1):
+            projection, active_d, kappa = self.get_projection(x[active], y[active], s[active])
+            d[active] = active_d
+            residuals[active] = np.abs(projection)
+            if i == self.iter_max:
+                break
+            # Newton step, falls back to a Gauss-Newton step behind the center of curvature
+            gain = 1 - kappa*active_d
+            gain = np.where(gain > 0.1, gain, 1.0)
+            s[active] = (s[active] + projection/gain) % self.raceline_length
+            active = active[np.abs(projection) > eps_m]
+            if len(active) == 0:
+                break
 
+        s = s.reshape(shape)
+        d = d.reshape(shape)
+        if return_residuals:
+            return s, d, residuals.reshape(shape)
         return s, d
 
+    def get_projection(self, x, y, s) -> tuple:
+        """
+        Returns the projection of the point on the tangent at s, its distance d to the
+        track and the curvature at s.
+        """
+        _, proj, d = self.check_perpendicular(x, y, s)
+        kappa, = self.interpolate_lut(s, self.lut_kappa)
+        return proj, d, kappa
+
     def check_perpendicular(self, x, y, s, eps_m=0.01) -> Union[bool, float]:
-        # obtain unit vector parallel to the track
-        dx_ds, dy_ds = self.get_derivative(s)
-        tangent = np.array([dx_ds, dy_ds])
         if np.any(np.isnan(s)):
             raise ValueError("BUB FRENET CONVERTER: S is nan")
-        tangent /= np.linalg.norm(tangent, axis=0)
+        # obtain unit vector parallel to the track, interpolated tangents are renormalized
+        track_x, track_y, tx, ty = self.interpolate_lut(s, self.lut_x, self.lut_y, self.lut_tx, self.lut_ty)
+        norm = np.hypot(tx, ty)
+        tx /= norm
+        ty /= norm
 
         # obtain vector from the track to the point
-        x_vec = x - self.spline_x(s)
-        y_vec = y - self.spline_y(s)
-        point_to_track = np.array([x_vec, y_vec])
-        
+        x_vec = x - track_x
+        y_vec = y - track_y
+
         # check if the vectors are perpendicular
         # computes the projection of point_to_track on tangent
-        proj = np.einsum('ij,ij->j', tangent, point_to_track)
-        perps = np.array([-tangent[1, :], tangent[0, :]])
-        d = np.einsum('ij,ij->j', perps, point_to_track)
+        proj = tx*x_vec + ty*y_vec
+        d = -ty*x_vec + tx*y_vec
 
         # TODO commented out because of computational efficiency
         # eps_m * point_to_track_norm is needed to make it scale invariant 
@@ -142,11 +311,16 @@ class FrenetConverter:
         Returns:
             der: dx/ds, dy/ds
         """
-        s = s%self.raceline_length
+        der = self.interpolate_lut(s, self.lut_dx, self.lut_dy)
 
-        der = [self.spline_x(s, 1), self.spline_y(s, 1)]
-        
         return der
+
+    def get_heading(self, s) -> np.array:
+        """
+        Returns the heading of the track at s in [-pi, pi).
+        """
+        psi, = self.interpolate_lut(s, self.lut_psi)
+        return (psi + np.pi) % (2*np.pi) - np.pi
     
     def get_cartesian(self, s: float, d: float) -> np.array:
         """
@@ -159,11 +333,9 @@ class FrenetConverter:
         Returns:
             np.array: [x, y] Cartesian coordinates
         """
-        x = self.spline_x(s)
-        y = self.spline_y(s)
-        psi = self.get_derivative(s)
-        psi = np.arctan2(psi[1], psi[0])
-        x += d * np.cos(psi + np.pi / 2)
-        y += d * np.sin(psi + np.pi / 2)
-        
+        x, y, tx, ty = self.interpolate_lut(s, self.lut_x, self.lut_y, self.lut_tx, self.lut_ty)
+        norm = np.hypot(tx, ty)
+        x = x - d * ty/norm
+        y = y + d * tx/norm
+
         return np.array([x, y])
\ No newline at end of file
@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 import math
-import rosbag
+import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from tf.transformations import euler_from_quaternion
 import os
 import shutil
-from alive_progress import alive_bar
+from utils.parallel import map_bags
+from utils.rosbag import extract_from_bag, FieldsExtractor
+from utils.time_alignment import nearest_indices, estimate_time_offset
 
 plt.rcParams.update({'font.size': 26})
 PLOT = True
@@ -19,10 +20,16 @@ BAGS = [
 ]
 
 MAX_DT = 0.1
+# Estimate and remove a constant latency of up to MAX_OFFSET seconds between estimate and GT.
+# Off by default: the "GT" here is the drive command, whose delay to the measured speed is part of what is compared
+ESTIMATE_OFFSET = False
+MAX_OFFSET = 0.5
 
 VEL_ALPHA = 0.0
 
 RESULTS_PATH = "carla_eval"
+# Number of bags evaluated in parallel, None uses all cores
+WORKERS = None
 overall_dt = 0
 
 EST_TOPIC = '/car_state/odom'
@@ -34,92 +41,69 @@ FIELDS = {
 
 
 class GtBuffer:
-    def __init__(self, topic_name, bag_path, gt_field):
-        self.bag_path = bag_path
-        self.buffer = []
-        self.curr_index = 0
-        self.subfields = gt_field.split('.')
-
-        # read into_buffer
-        with rosbag.Bag(bag_path) as vicon_bag:
-            for _, msg, t in vicon_bag.read_messages(topics=[topic_name]):
-                all_fields = msg.__getattribute__(self.subfields[0])
-                for subfield in self.subfields[1:]:
-                    all_fields = all_fields.__getattribute__(subfield)
-                self.buffer.append((all_fields, t.to_sec()))
-
-
-    def get_gt_at_time(self, time):
-        global overall_dt
-        if time < self.buffer[0][1] - MAX_DT:
-            return None
-        if time > self.buffer[-1][1] + MAX_DT:
-            return None
-        low_index = max(self.curr_index - 50, 0)
-        high_index = min(self.curr_index + 50, len(self.buffer) - 1)
-        small_buff = self.buffer[low_index : high_index]
-        self.curr_index =  self.buffer.index(min(small_buff, key=lambda x: abs(x[1] - time)))
-        if abs(time - self.buffer[self.curr_index][1]) > MAX_DT:
-            return None
-        overall_dt += abs(self.buffer[self.curr_index][1] - time)
-        return self.buffer[self.curr_index][0]
-
-def get_yaw(msg, vicon=False):
-    if not vicon:
-        return euler_from_quaternion([
-            msg.pose.pose.orientation.x,
-            msg.pose.pose.orientation.y,
-            msg.pose.pose.orientation.z,
-            msg.pose.pose.orientation.w])[2]
-    else:
-        return euler_from_quaternion([
-            msg.transform.rotation.x,
-            msg.transform.rotation.y,
-            msg.transform.rotation.z,
-            msg.transform.rotation.w])[2]
+    def __init__(self, times, values):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.values = np.asarray(values, dtype=np.float64)
+
+    def get_gt_at_times(self, times):
+        """
+        Indices of the ground truth samples closest to `times` and whether they are within MAX_DT.
+        """
+        return nearest_indices(times, self.times, MAX_DT)
 
 def evaluate_bag(bag_path):
-    error = 0
-
-    gt_buffer = GtBuffer(GT_TOPIC, bag_path, FIELDS["gt"])
-    est_subfields = FIELDS['est'].split('.')
-    print(est_subfields)
-    i = 0
-    with rosbag.Bag(bag_path) as bag:
-        n = bag.get_message_count(EST_TOPIC)
-        data = []
-        with alive_bar(n) as bar:
-            for _, msg, t in bag.read_messages(topics=[EST_TOPIC]):
-                gt_msg = gt_buffer.get_gt_at_time(t.to_sec())
-                bar()
-
-                if gt_msg is  None or gt_buffer.curr_index == 0:
-                    print('No GT data at time: ', t.to_sec())
-                    continue
-
-                all_fields = msg.__getattribute__(est_subfields[0])
-                for subfield in est_subfields[1:]:
-                    all_fields = all_fields.__getattribute__(subfield)
-
-                est_msg = all_fields
-                # compute mean squared error
-                error = (gt_msg - est_msg)**2
-                    # add to dataframe
-                if PLOT:
-                    data.append({
-                        "time": t.to_sec(),
-                        "GT": gt_msg,
-                        "estimate": est_msg,
-                    })
-
-                i+=1
-
-    error = int(math.sqrt(error/i) * 10000) / 10000
+    global overall_dt
+    frames = extract_from_bag(bag_path, {
+        "gt": FieldsExtractor(GT_TOPIC, [FIELDS["gt"]]),
+        "est": FieldsExtractor(EST_TOPIC, [FIELDS["est"]]),
+    })
+    gt_buffer = GtBuffer(frames["gt"]["time"], frames["gt"][FIELDS["gt"]])
+    est_times = frames["est"]["time"].to_numpy()
+    est = frames["est"][FIELDS["est"]].to_numpy()
+    if ESTIMATE_OFFSET:
+        try:
+            offset = estimate_time_offset(est_times, est, gt_buffer.times, gt_buffer.values, MAX_OFFSET)
+        except ValueError as e:
+            print('Warning: cannot estimate the latency, assuming 0: ', e)
+            offset = 0.0
+        print('Estimated latency [s]: ', offset)
+        est_times = est_times - offset
+
+    # match every estimate to the closest ground truth sample in one pass
+    indices, valid = gt_buffer.get_gt_at_times(est_times)
+    valid &= indices > 0
+    if not np.all(valid):
+        print('No GT data for ', np.count_nonzero(~valid), ' samples')
+    indices = indices[valid]
+    i = len(indices)
+    if i == 0:
+        raise ValueError("No matching GT data in bag: ", bag_path)
+    overall_dt += np.sum(np.abs(gt_buffer.times[indices] - est_times[valid]))
+
+    gt = gt_buffer.values[indices]
+    est = est[valid]
+    error = int(math.sqrt(np.mean((gt - est)**2)) * 10000) / 10000
+    data = []
+    if PLOT:
+        data = {
+            "time": est_times[valid],
+            "GT": gt,
+            "estimate": est,
+        }
     print('Mean Squared Error: ', error)
     print('Number of samples: ', i)
     return  pd.DataFrame(data), [error]
 
 
+def evaluate(bag_name):
+    global overall_dt
+    # runs in a worker process, so overall_dt is returned per bag
+    overall_dt = 0
+    print('Evaluating: ', bag_name)
+    data, errors = evaluate_bag(os.path.join(PATH_ROOT, bag_name))
+    return data, errors, overall_dt
+
+
 def plot_data(df, path, title, x_label, y_label, col_bag, col_vicon, y_lim=None):
     start_time = df['time'].iloc[0]
     figure= plt.figure( figsize=[10, 10])
@@ -156,14 +140,14 @@ def main():
                 return
     os.mkdir(dirpath)
 
-    data = []
-    for bag_name in BAGS:
+    results = map_bags(evaluate, BAGS, WORKERS)
+    total_dt = 0
+    for bag_name, (data, errors, bag_dt) in zip(BAGS, results):
+        total_dt += bag_dt
         bagdir = os.path.join(dirpath, bag_name.replace('.bag', ''))
         if os.path.exists(bagdir) and os.path.isdir(bagdir):
             shutil.rmtree(bagdir)
         os.mkdir(bagdir)
-        print('Evaluating: ', bag_name)
-        data, errors = evaluate_bag(os.path.join(PATH_ROOT, bag_name))
         write_errors(errors, os.path.join(bagdir, "errors.txt"))
         est_field = FIELDS['est']
         if PLOT:
@@ -179,7 +163,7 @@ def main():
             )
 
         print('')
-    print('Overall dt: ', overall_dt)
+    print('Overall dt: ', total_dt)
 
 
 if __name__ == '__main__':
@@ -1,12 +1,11 @@
 #!/usr/bin/env python3
-import rosbag
 import matplotlib.pyplot as plt
 import pandas as pd
-from tf.transformations import euler_from_quaternion
-from alive_progress import alive_bar
 import os
 import shutil
 import time
+from utils.parallel import map_bags
+from utils.rosbag import extract_fields
 
 plt.rcParams.update({'font.size': 26})
 TOPICS = ['/vesc/high_level/ackermann_cmd_mux/input/nav_1']
@@ -23,49 +22,21 @@ BAGS = [
 ]
 
 RESULTS_PATH = "accel_test"
+# Number of bags read in parallel, None uses all cores
+WORKERS = None
 
 start_offset = 0
 
 
 def get_data(bag_path):
-    start_time = None
-    data = []
-    with rosbag.Bag(bag_path) as bag:
-        n = 0
-        for t in TOPICS:
-            n += bag.get_message_count(t)
-        if n == 0:
-            print("No messages in bag")
-            return
-
-        with alive_bar(n) as bar:
-            for topic, msg, t in bag.read_messages(topics=TOPICS):
-                if start_time is None:
-                    start_time = t.to_sec()
-
-                if t.to_sec() - start_time < start_offset:
-                    bar()
-                    continue
-
-
-                data_dict = {
-                    "time": t.to_sec() - start_time,
-                }
-
-                topic_index = TOPICS.index(topic)
-
-
-                for field in FIELDS[topic_index]:
-                    subfields = field.split('.')
-                    all_fields = msg.__getattribute__(subfields[0])
-                    for subfield in subfields[1:]:
-                        all_fields = all_fields.__getattribute__(subfield)
-                    data_dict[field] = all_fields
+    frames = extract_fields(bag_path, dict(zip(TOPICS, FIELDS)))
+    data = pd.concat(frames.values(), ignore_index=True).sort_values("time", kind="stable", ignore_index=True)
+    if len(data) == 0:
+        print("No messages in bag")
+        return
 
-            
-                data.append(data_dict)
-                bar()
-    return  pd.DataFrame(data)
+    data["time"] -= data["time"].iloc[0]
+    return data[data["time"] >= start_offset].reset_index(drop=True)
 
 
 def plot_data(data, path, x_label, y_label, col_bag):
@@ -98,10 +69,8 @@ def main():
             print("Exiting")
             return
     os.mkdir(dirpath)
-    data = []
-    for bag_name in BAGS:
-        print('Evaluating: ', bag_name)
-        data.append(get_data(PATH_ROOT + bag_name))
+    print('Evaluating: ', BAGS)
+    data = map_bags(get_data, [PATH_ROOT + bag_name for bag_name in BAGS], WORKERS)
     for field in FIELD_DESCRIPTORS.keys():
         plot_data(data, os.path.join(dirpath, field + '.pdf'), 'Time [s]', FIELD_DESCRIPTORS[field], field)
 
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from typing import Any, Optional
+
+# Mounted as a volume in docker-compose.yaml, see setup.sh
+CACHE_DIR = os.environ.get("ROS_EVAL_CACHE_DIR", os.path.expanduser("~/ros_eval/cache"))
+CACHE_MAX_BYTES = int(os.environ.get("ROS_EVAL_CACHE_MAX_BYTES", 4 * 1024**3))
+# Bump whenever the extractors change what they return
+CACHE_VERSION = 1
+
+
+class BagCache:
+    """
+    Persistent cache of extracted bag results stored as uncompressed .npz files.
+
+    Entries are keyed by the bag path, size and mtime together with the
+    topic and the extractor arguments, so a re-recorded or modified bag
+    never hits a stale entry. The least recently used entries are evicted
+    once the directory grows past `max_bytes`.
+    """
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self) -> bool:
+        return os.path.isdir(self.cache_dir)
+
+    def key(self, bagpath: str, topic: str, params: dict) -> str:
+        stat = os.stat(bagpath)
+        ident = {
+            "version": CACHE_VERSION,
+            "bag": os.path.abspath(bagpath),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "topic": topic,
+            "params": params,
+        }
+        return hashlib.sha1(json.dumps(ident, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def load(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                result = _decode(npz)
+        except (OSError, ValueError, KeyError):
+            return None
+        # mtime doubles as the LRU timestamp
+        os.utime(path)
+        return result
+
+    def store(self, key: str, result: Any):
+        arrays = _encode(result)
+        if arrays is None:
+            return
+        path = self._path(key)
+        tmp_path = os.path.join(self.cache_dir, f"{key}.{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npz") or name.endswith(".tmp.npz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+def _encode(result: Any) -> Optional[dict]:
+    '''
+    Flattens a DataFrame, or a tuple/list of DataFrames, into named arrays.
+    Returns None if the result cannot be stored without pickling.
+    '''
+    if isinstance(result, pd.DataFrame):
+        kind, frames = "frame", [result]
+    elif isinstance(result, (tuple, list)) and all(isinstance(f, pd.DataFrame) for f in result):
+        kind, frames = type(result).__name__, list(result)
+    else:
+        return None
+
+    arrays = {}
+    layout = {"kind": kind, "frames": []}
+    for i, frame in enumerate(frames):
+        columns = [str(c) for c in frame.columns]
+        for j, column in enumerate(columns):
+            values = frame.iloc[:, j].to_numpy()
+            if values.dtype == object:
+                return None
+            arrays[f"f{i}_c{j}"] = values
+        layout["frames"].append(columns)
+    arrays["layout"] = np.array(json.dumps(layout))
+    return arrays
+
+
+def _decode(npz) -> Any:
+    layout = json.loads(str(npz["layout"]))
+    frames = []
+    for i, columns in enumerate(layout["frames"]):
+        frames.append(pd.DataFrame({column: npz[f"f{i}_c{j}"] for j, column in enumerate(columns)}, columns=columns))
+    if layout["kind"] == "frame":
+        return frames[0]
+    if layout["kind"] == "tuple":
+        return tuple(frames)
+    return frames
@@ -0,0 +1,102 @@
+import numpy as np
+from scipy.signal import butter, filtfilt, savgol_filter
+from typing import Tuple
+
+'''
+    Velocities from sampled poses, computed on whole arrays at once.
+'''
+
+METHODS = ["central", "savgol"]
+
+
+def _unique_times(times, values):
+    # repeated timestamps would make the time steps zero
+    times, index = np.unique(np.asarray(times, dtype=np.float64), return_index=True)
+    return times, np.asarray(values, dtype=np.float64)[index]
+
+
+def differentiate(times, values, method="savgol", window=0.2, polyorder=2) -> np.ndarray:
+    '''
+    Time derivative of (N,) or (N, k) values sampled at `times`.
+
+    Parameters:
+    times (np.array): Sorted sample times, repeated times are ignored.
+    values (np.array): The sampled values.
+    method (str): "central" for central differences using the actual time
+        steps, "savgol" for a Savitzky-Golay derivative on a uniform grid.
+    window (float): Length of the Savitzky-Golay window in seconds.
+    polyorder (int): Order of the Savitzky-Golay polynomial.
+
+    Returns:
+        np.ndarray: The derivative at every input time.
+    '''
+    if method not in METHODS:
+        raise ValueError("Unknown differentiation method: ", method)
+    query_times = np.asarray(times, dtype=np.float64)
+    times, values = _unique_times(query_times, values)
+    if len(times) < 3:
+        return np.zeros((len(query_times),) + values.shape[1:])
+
+    if method == "central":
+        derivative = np.gradient(values, times, axis=0)
+        grid = times
+    else:
+        dt = np.median(np.diff(times))
+        grid = np.arange(times[0], times[-1] + dt / 2, dt)
+        uniform = np.stack([np.interp(grid, times, v) for v in values.reshape(len(times), -1).T], axis=1)
+        window_length = max(int(round(window / dt)) | 1, polyorder + 1 + polyorder % 2)
+        window_length = min(window_length, len(grid) - (1 - len(grid) % 2))
+        if window_length <= polyorder:
+            derivative = np.gradient(uniform, dt, axis=0)
+        else:
+            derivative = savgol_filter(uniform, window_length, polyorder, deriv=1, delta=dt, axis=0)
+
+    derivative = derivative.reshape(len(grid), -1)
+    result = np.stack([np.interp(query_times, grid, d) for d in derivative.T], axis=1)
+    return result.reshape((len(query_times),) + values.shape[1:])
+
+
+def lowpass(times, values, cutoff, order=2) -> np.ndarray:
+    '''
+    Zero-phase Butterworth low-pass filter of (N,) or (N, k) values,
+    using the median sampling rate.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    rate = 1.0 / np.median(np.diff(times))
+    if cutoff >= rate / 2 or len(values) <= 3 * (order + 1):
+        return values
+    b, a = butter(order, cutoff, fs=rate)
+    return filtfilt(b, a, values, axis=0)
+
+
+def body_velocities(
+    times,
+    xy,
+    yaw,
+    method="savgol",
+    window=0.2,
+    cutoff=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Body frame velocities of a planar trajectory.
+
+    Parameters:
+    times (np.array): Sorted sample times.
+    xy (np.array): (N, 2) positions in the world frame.
+    yaw (np.array): (N,) yaws, they are unwrapped before differentiating.
+    method (str): See differentiate.
+    window (float): See differentiate.
+    cutoff (float): Optional low-pass cutoff frequency in Hz applied to the velocities.
+
+    Returns:
+        vx, vy, yaw_rate
+    '''
+    yaw = np.asarray(yaw, dtype=np.float64)
+    states = np.column_stack([np.asarray(xy, dtype=np.float64)[:, :2], np.unwrap(yaw)])
+    rates = differentiate(times, states, method, window)
+    if cutoff is not None:
+        rates = lowpass(times, rates, cutoff)
+    cos_yaw = np.cos(yaw)
+    sin_yaw = np.sin(yaw)
+    vx = cos_yaw * rates[:, 0] + sin_yaw * rates[:, 1]
+    vy = -sin_yaw * rates[:, 0] + cos_yaw * rates[:, 1]
+    return vx, vy, rates[:, 2]
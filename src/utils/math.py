@@ -1,4 +1,10 @@
-from tf.transformations import euler_from_quaternion
+import math
+import numpy as np
+
+'''
+    Quaternions are given as [x, y, z, w] like in geometry_msgs/Quaternion.
+    The angles follow the static xyz convention of tf.transformations.
+'''
 
 def get_yaw(msg):
     """
@@ -8,9 +14,59 @@ def get_yaw(msg):
     Returns:
         float: The yaw in radians.
     """
-    return euler_from_quaternion([
+    return yaw_from_quaternion(
         msg.pose.pose.orientation.x,
         msg.pose.pose.orientation.y,
         msg.pose.pose.orientation.z,
         msg.pose.pose.orientation.w
-    ])[2]
\ No newline at end of file
+    )
+
+
+def yaw_from_quaternion(x, y, z, w):
+    """
+    Computes yaw from the components of a quaternion.
+    Returns:
+        float: The yaw in radians.
+    """
+    return math.atan2(2 * (w * z + x * y), w * w + x * x - y * y - z * z)
+
+
+def quaternions_to_yaw(quaternions: np.ndarray, unwrap=False) -> np.ndarray:
+    """
+    Computes the yaw of (N, 4) quaternions.
+    Parameters:
+        quaternions (np.ndarray): One [x, y, z, w] quaternion per row, need not be normalized.
+        unwrap (bool): Remove the 2 pi jumps between consecutive yaws.
+    Returns:
+        np.ndarray: The (N,) yaws in radians.
+    """
+    x, y, z, w = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4).T
+    yaw = np.arctan2(2 * (w * z + x * y), w * w + x * x - y * y - z * z)
+    return np.unwrap(yaw) if unwrap else yaw
+
+
+def quaternions_to_rpy(quaternions: np.ndarray, unwrap=False) -> np.ndarray:
+    """
+    Computes roll, pitch and yaw of (N, 4) quaternions.
+    Parameters:
+        quaternions (np.ndarray): One [x, y, z, w] quaternion per row, need not be normalized.
+        unwrap (bool): Remove the 2 pi jumps of roll and yaw between consecutive rows.
+    Returns:
+        np.ndarray: (N, 3) roll, pitch and yaw in radians.
+    """
+    x, y, z, w = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4).T
+    norm_sq = w * w + x * x + y * y + z * z
+    roll = np.arctan2(2 * (w * x + y * z), w * w - x * x - y * y + z * z)
+    pitch = np.arcsin(np.clip(2 * (w * y - z * x) / norm_sq, -1.0, 1.0))
+    yaw = np.arctan2(2 * (w * z + x * y), w * w + x * x - y * y - z * z)
+    if unwrap:
+        roll = np.unwrap(roll)
+        yaw = np.unwrap(yaw)
+    return np.stack([roll, pitch, yaw], axis=1)
+
+
+def wrap_angle(angle):
+    """
+    Wraps angles to [-pi, pi).
+    """
+    return (np.asarray(angle) + np.pi) % (2 * np.pi) - np.pi
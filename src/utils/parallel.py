@@ -0,0 +1,25 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, List
+
+
+def map_bags(fn: Callable[[str], Any], bags: List[str], workers: int = None) -> List[Any]:
+    '''
+    Runs fn on every bag in a process pool.
+
+    Parameters:
+    fn (Callable): Module level function taking a bag, must be picklable.
+    bags (List[str]): The bags to process.
+    workers (int): Number of worker processes, defaults to the number of cores.
+        With a single worker everything runs in the current process.
+
+    Returns:
+        List[Any]: The results of fn, in the order of bags.
+    '''
+    if workers is None:
+        workers = os.cpu_count()
+    workers = min(workers, len(bags))
+    if workers <= 1:
+        return [fn(bag) for bag in bags]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, bags))
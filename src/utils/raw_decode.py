@@ -0,0 +1,117 @@
+import struct
+from collections import namedtuple
+
+'''
+    Fast decoding of fixed-layout messages read with read_messages(raw=True).
+
+    Each decoder takes the serialized message buffer and unpacks only the
+    fields we use with precompiled structs, skipping over strings and
+    covariances. Types without a decoder are deserialized normally.
+'''
+
+PoseRecord = namedtuple("PoseRecord", ["stamp", "x", "y", "z", "qx", "qy", "qz", "qw"])
+OdometryRecord = namedtuple(
+    "OdometryRecord",
+    ["stamp", "x", "y", "z", "qx", "qy", "qz", "qw", "vx", "vy", "vz", "wx", "wy", "wz"]
+)
+
+_HEADER = struct.Struct("<3I")
+_UINT32 = struct.Struct("<I")
+_POSE = struct.Struct("<7d")
+_TWIST = struct.Struct("<6d")
+_COVARIANCE_SIZE = 36 * 8
+
+
+def _skip_string(buf, offset):
+    length, = _UINT32.unpack_from(buf, offset)
+    return offset + 4 + length
+
+
+def _read_header(buf):
+    '''
+    Returns the header stamp in seconds and the offset after the header.
+    '''
+    _, secs, nsecs = _HEADER.unpack_from(buf, 0)
+    return secs + nsecs * 1e-9, _skip_string(buf, _HEADER.size)
+
+
+def decode_odometry(buf) -> OdometryRecord:
+    stamp, offset = _read_header(buf)
+    offset = _skip_string(buf, offset)  # child_frame_id
+    pose = _POSE.unpack_from(buf, offset)
+    offset += _POSE.size + _COVARIANCE_SIZE
+    twist = _TWIST.unpack_from(buf, offset)
+    return OdometryRecord(stamp, *pose, *twist)
+
+
+def decode_transform_stamped(buf) -> PoseRecord:
+    stamp, offset = _read_header(buf)
+    offset = _skip_string(buf, offset)  # child_frame_id
+    return PoseRecord(stamp, *_POSE.unpack_from(buf, offset))
+
+
+def decode_pose_stamped(buf) -> PoseRecord:
+    stamp, offset = _read_header(buf)
+    return PoseRecord(stamp, *_POSE.unpack_from(buf, offset))
+
+
+def _read_string(buf, offset):
+    length, = _UINT32.unpack_from(buf, offset)
+    start = offset + 4
+    return bytes(buf[start:start + length]).decode(), start + length
+
+
+def image_layout(buf):
+    '''
+    Locates the pixel data of a serialized sensor_msgs/Image.
+
+    Returns:
+        stamp, height, width, encoding, step, offset and length of the data
+    '''
+    stamp, offset = _read_header(buf)
+    height, width = struct.unpack_from("<2I", buf, offset)
+    encoding, offset = _read_string(buf, offset + 8)
+    # skip is_bigendian
+    step, length = struct.unpack_from("<2I", buf, offset + 1)
+    return stamp, height, width, encoding, step, offset + 9, length
+
+
+def compressed_image_layout(buf):
+    '''
+    Locates the data of a serialized sensor_msgs/CompressedImage.
+
+    Returns:
+        stamp, format, offset and length of the data
+    '''
+    stamp, offset = _read_header(buf)
+    fmt, offset = _read_string(buf, offset)
+    length, = _UINT32.unpack_from(buf, offset)
+    return stamp, fmt, offset + 4, length
+
+
+DECODERS = {
+    "nav_msgs/Odometry": decode_odometry,
+    "geometry_msgs/TransformStamped": decode_transform_stamped,
+    "geometry_msgs/PoseStamped": decode_pose_stamped,
+}
+
+
+def can_decode(datatype: str) -> bool:
+    return datatype in DECODERS
+
+
+def decode(raw):
+    '''
+    Decodes a raw message tuple as returned by read_messages(raw=True).
+    '''
+    datatype, data = raw[0], raw[1]
+    return DECODERS[datatype](data)
+
+
+def deserialize(raw):
+    '''
+    Fallback for types without a decoder: full genpy deserialization.
+    '''
+    msg = raw[4]()
+    msg.deserialize(raw[1])
+    return msg
@@ -1,22 +1,111 @@
+import hashlib
+import operator
 import pandas as pd
 import alive_progress
-from utils.math import get_yaw
+from utils.math import quaternions_to_yaw
+from utils.bag_cache import BagCache
+from utils import raw_decode
 import rosbag
 import numpy as np
-from typing import List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import genpy
 from sensor_msgs.msg import Image
 
 
-def get_markers_before(bagpath, topic, time):
-    last_valid_markers = None
+def _to_time(seconds):
+    return None if seconds is None else genpy.Time.from_sec(seconds)
 
-    with rosbag.Bag(bagpath) as bag:
-        messages = bag.read_messages(topics=[topic])
-        for _, msg, _ in messages:
-            t = msg.markers[0].header.stamp.to_sec()
-            if t > time:
-                break
-            last_valid_markers = msg.markers
+def _nsec_to_time(nsecs):
+    return genpy.Time(*divmod(int(nsecs), 10**9))
+
+def _entry_stamps(bag, topics, start_time=None, end_time=None) -> np.ndarray:
+    '''
+    Receive times in nanoseconds of all messages on `topics`, taken from
+    the bag's index without reading any message data.
+    '''
+    connections = list(bag._get_connections(topics=topics))
+    entries = bag._get_entries(connections, start_time, end_time)
+    return np.fromiter((entry.time.to_nsec() for entry in entries), dtype=np.int64)
+
+
+class TopicIndex:
+    """
+    Receive-time index of a single topic for repeated time lookups.
+
+    The bag stays open for the lifetime of the index, so every lookup
+    seeks through the chunk index instead of reading the topic from the
+    start. Use it as a context manager or call close().
+    """
+    def __init__(self, bagpath, topic):
+        self.topic = topic
+        self.bag = rosbag.Bag(bagpath)
+        self.stamps = _entry_stamps(self.bag, [topic])
+        self.times = self.stamps * 1e-9
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.bag.close()
+
+    def index_before(self, time) -> int:
+        '''
+        Index of the latest message received at or before `time`, -1 if there is none.
+        '''
+        return int(np.searchsorted(self.times, time, side="right")) - 1
+
+    def read_from(self, index, raw=False):
+        '''
+        Reads the topic starting at the message with the given index.
+        '''
+        if len(self.stamps) == 0:
+            return iter(())
+        if index <= 0:
+            return self.bag.read_messages(topics=[self.topic], raw=raw)
+        messages = self.bag.read_messages(topics=[self.topic], start_time=_nsec_to_time(self.stamps[index]), raw=raw)
+        # skip messages received at the same time but before the requested one
+        for _ in range(index - int(np.searchsorted(self.stamps, self.stamps[index], side="left"))):
+            next(messages, None)
+        return messages
+
+    def latest_before(self, time):
+        '''
+        The latest message received at or before `time`, None if there is none.
+        '''
+        index = self.index_before(time)
+        if index < 0:
+            return None
+        for _, msg, _ in self.read_from(index):
+            return msg
+
+
+def get_markers_before(bagpath, topic, time, index: TopicIndex = None):
+    '''
+    Get the markers of the last message on `topic` stamped at or before `time`.
+
+    Pass a TopicIndex of the topic when querying many times (e.g. once per
+    video frame) to keep the bag open between lookups.
+    '''
+    if index is None:
+        with TopicIndex(bagpath, topic) as index:
+            return get_markers_before(bagpath, topic, time, index)
+
+    last_valid_markers = None
+    # messages are stamped before they are received, so reading can start
+    # at the last message received before `time`
+    for _, msg, _ in index.read_from(max(index.index_before(time), 0)):
+        t = msg.markers[0].header.stamp.to_sec()
+        if t > time:
+            break
+        last_valid_markers = msg.markers
 
     if not last_valid_markers:
         return pd.DataFrame(columns=["x", "y"])
@@ -26,54 +115,91 @@ def get_markers_before(bagpath, topic, time):
         columns=["x", "y"]
     )
 
-def get_markers(bagpath, topic):
-    last_valid_markers = None
+def get_markers(bagpath, topic, start_time=None, end_time=None, workers=1):
+    return extract_from_bag(
+        bagpath,
+        {"markers": MarkersExtractor(topic)},
+        title="Markers",
+        start_time=start_time,
+        end_time=end_time,
+        workers=workers
+    )["markers"]
 
-    with rosbag.Bag(bagpath) as bag:
-        messages = bag.read_messages(topics=[topic])
-        data = []
-        for _, msg, _ in messages:
-            for m in msg.markers:
-                data.append({
-                    "x": m.pose.position.x,
-                    "y": m.pose.position.y,
-                })
-        return pd.DataFrame(data)
 
+def _opponent_trajectory_frames(msg) -> List[pd.DataFrame]:
+    traj_data = []
+    for opp in msg.trajectories:
+        opp_data = []
+        for wpnt in opp.oppwpnts:
+            new_wpnt = {
+                "x": wpnt.x_m,
+                "y": wpnt.y_m,
+                "var": wpnt.d_var,
+                "vs": wpnt.proj_vs_mps,
+                "v_var": wpnt.vs_var,
+                "d": wpnt.d_m,
+                "s": wpnt.s_m,
+            }
+            opp_data.append(new_wpnt)
+        traj_data.append(pd.DataFrame(opp_data))
+    return traj_data
 
 
+OPPONENT_TRAJECTORY_COLUMNS = {
+    "msg_time": np.float64,
+    "opp_index": np.int32,
+    "wpnt_index": np.int32,
+    "x": np.float64,
+    "y": np.float64,
+    "s": np.float64,
+    "d": np.float64,
+    "vs": np.float64,
+    "var": np.float64,
+    "v_var": np.float64,
+}
 
-def get_opponents_trajectories(bagpath, topic="/perception/opp_trajectories", last_only=True):
-    with rosbag.Bag(bagpath) as bag:
-        last_msg = None
-        msgs = []
-        for _, msg, _ in bag.read_messages(topics=[topic]):
-            msgs.append(msg)
-        if len(msgs) == 0:
+
+def get_opponents_trajectories(bagpath, topic="/perception/opp_trajectories", last_only=True, last_n=None, flat=False):
+    '''
+    Get the predicted opponent trajectories as one list of DataFrames per message.
+
+    The final messages are located through the bag index, so with
+    `last_only` (or `last_n`) only those are read and deserialized.
+    Messages are converted one at a time and never kept.
+
+    Parameters:
+    bagpath (str): The path to the rosbag file.
+    topic (str): The opponent trajectory topic.
+    last_only (bool): Only return the last message.
+    last_n (int): Only return the last n messages, takes precedence over last_only.
+    flat (bool): Return a single long-format DataFrame with one row per
+        waypoint instead, see OPPONENT_TRAJECTORY_COLUMNS. msg_time is the
+        bag time of the message.
+    '''
+    if last_n is None and last_only:
+        last_n = 1
+    with TopicIndex(bagpath, topic) as index:
+        if len(index) == 0:
             raise ValueError("No messages found in bag for topic: ", topic)
+        first = 0 if last_n is None else max(len(index) - last_n, 0)
+        if not flat:
+            return [_opponent_trajectory_frames(msg) for _, msg, _ in index.read_from(first)]
 
-    if last_only:
-        msgs = [msgs[-1]]
-    data = []
-    for m in msgs:
-        traj_data = []
-        for i, opp in enumerate(m.trajectories):
-            opp_data = []
-            print(i)
-            for wpnt in opp.oppwpnts:
-                new_wpnt = {
-                    "x": wpnt.x_m,
-                    "y": wpnt.y_m,
-                    "var": wpnt.d_var,
-                    "vs": wpnt.proj_vs_mps,
-                    "v_var": wpnt.vs_var,
-                    "d": wpnt.d_m,
-                    "s": wpnt.s_m,
-                }
-                opp_data.append(new_wpnt)
-            traj_data.append(pd.DataFrame(opp_data))
-        data.append(traj_data)
-    return data
+        columns = None
+        for _, msg, t in index.read_from(first):
+            if columns is None:
+                # size the columns assuming every message looks like the first
+                rows = sum(len(opp.oppwpnts) for opp in msg.trajectories)
+                columns = _Columns(OPPONENT_TRAJECTORY_COLUMNS, capacity=max(rows * (len(index) - first), 1))
+            msg_time = t.to_sec()
+            for i, opp in enumerate(msg.trajectories):
+                for j, wpnt in enumerate(opp.oppwpnts):
+                    columns.append(
+                        msg_time, i, j,
+                        wpnt.x_m, wpnt.y_m, wpnt.s_m, wpnt.d_m,
+                        wpnt.proj_vs_mps, wpnt.d_var, wpnt.vs_var
+                    )
+        return pd.DataFrame(columns.arrays(), copy=False)
 
 
 def get_topics_in_bag(bagpath: str) -> List[str]:
@@ -102,6 +228,7 @@ def get_images_as_list(
     image_topic: str) -> List[Image]:
     '''
     Get a list of images from a rosbag.
+    Keeps every message in memory, use iter_images for long recordings.
     
     Parameters:
     bagpath (str): The path to the rosbag file.
@@ -115,138 +242,746 @@ def get_images_as_list(
         return [msg for _, msg, _ in bag.read_messages(topics=[image_topic])]
     
 
-def get_detections_from_bag(bagpath, fc, detection_topic="/perception/obstacles"):
+class _Columns:
+    """
+    Growable typed NumPy columns, doubling their capacity when full.
+    """
+    def __init__(self, dtypes: Dict[str, Any], capacity=1024):
+        self.names = list(dtypes.keys())
+        self.data = [np.empty(capacity, dtype=dtype) for dtype in dtypes.values()]
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self, capacity):
+        for j, column in enumerate(self.data):
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.n] = column[:self.n]
+            self.data[j] = grown
+
+    def append(self, *row):
+        if self.n == len(self.data[0]):
+            self._grow(max(2 * self.n, 1024))
+        for column, value in zip(self.data, row):
+            column[self.n] = value
+        self.n += 1
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {name: column[:self.n] for name, column in zip(self.names, self.data)}
+
+
+class Extractor:
+    """
+    Base class for the per-topic extractors used by extract_from_bag.
+
+    An extractor consumes the messages of a single topic and turns them
+    into its result (usually a pandas DataFrame). Setting `done` signals
+    that no further messages are needed. Extractors whose `cache_key`
+    returns a dict of their arguments can be served from the bag cache.
+
+    Extractors listing message types in `raw_types` receive the fields
+    decoded by utils.raw_decode through `add_raw` instead of a full
+    message for those types.
+    """
+    raw_types = ()
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.done = False
+
+    def begin(self, bag, n):
+        pass
+
+    def add(self, msg, t):
+        raise NotImplementedError
+
+    def add_raw(self, record, t):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    def cache_key(self) -> Optional[dict]:
+        return None
+
+    def partial(self) -> Optional["Extractor"]:
+        '''
+        A fresh extractor for one time slice of a parallel read, None if
+        the extractor cannot be split.
+        '''
+        return None
+
+    def partial_result(self):
+        '''
+        Picklable state of a slice extractor, passed to merge.
+        '''
+        raise NotImplementedError
+
+    def merge(self, parts: List[Any]):
+        '''
+        Combines the partial results of all slices, in time order, into the result.
+        '''
+        raise NotImplementedError
+
+
+class StatesExtractor(Extractor):
+    """
+    Fills preallocated NumPy columns from odometry messages.
+
+    The columns are sized from the message count of the topic, the time
+    column is always float64 while the others use `dtype`. Orientations are
+    collected as quaternions and converted to yaw in one batch at the end.
+    """
+    raw_types = ("nav_msgs/Odometry",)
+
+    def __init__(self, topic="/car_state/odom", frenet=False, normalize_time=False, dtype=np.float64):
+        super().__init__(topic)
+        self.frenet = frenet
+        self.normalize_time = normalize_time
+        self.dtype = np.dtype(dtype)
+        if frenet:
+            self.column_names = ['time', 's', 'd', 'vs']
+        else:
+            self.column_names = [
+                'time',
+                'position_x',
+                'position_y',
+                'velocity_x',
+                'velocity_y',
+                'yaw',
+                'yaw_rate'
+            ]
+        self.columns = None
+        self.quaternions = None
+        self.n = 0
+        self.start_time = 0
+
+    def _allocate(self, capacity):
+        columns = [np.empty(capacity, dtype=np.float64)]
+        columns += [np.empty(capacity, dtype=self.dtype) for _ in self.column_names[1:]]
+        quaternions = None if self.frenet else np.empty((capacity, 4), dtype=np.float64)
+        if self.columns is not None:
+            for new, old in zip(columns, self.columns):
+                new[:self.n] = old[:self.n]
+            if quaternions is not None:
+                quaternions[:self.n] = self.quaternions[:self.n]
+        self.columns = columns
+        self.quaternions = quaternions
+
+    def _fill_yaw(self):
+        if self.quaternions is not None:
+            self.columns[5][:self.n] = quaternions_to_yaw(self.quaternions[:self.n])
+
+    def begin(self, bag, n):
+        self._allocate(n)
+
+    def add_raw(self, record, t):
+        if self.columns is None or self.n == len(self.columns[0]):
+            self._allocate(max(2 * self.n, 1024))
+        columns = self.columns
+        i = self.n
+        if self.normalize_time and self.start_time == 0:
+            self.start_time = record.stamp
+        columns[0][i] = record.stamp - self.start_time
+        columns[1][i] = record.x
+        columns[2][i] = record.y
+        columns[3][i] = record.vx
+        if not self.frenet:
+            columns[4][i] = record.vy
+            self.quaternions[i] = (record.qx, record.qy, record.qz, record.qw)
+            columns[6][i] = record.wz
+        self.n += 1
+
+    def add(self, msg, t):
+        if self.columns is None or self.n == len(self.columns[0]):
+            self._allocate(max(2 * self.n, 1024))
+        columns = self.columns
+        i = self.n
+        stamp = msg.header.stamp.to_sec()
+        if self.normalize_time and self.start_time == 0:
+            self.start_time = stamp
+        columns[0][i] = stamp - self.start_time
+        columns[1][i] = msg.pose.pose.position.x
+        columns[2][i] = msg.pose.pose.position.y
+        columns[3][i] = msg.twist.twist.linear.x
+        if not self.frenet:
+            columns[4][i] = msg.twist.twist.linear.y
+            orientation = msg.pose.pose.orientation
+            self.quaternions[i] = (orientation.x, orientation.y, orientation.z, orientation.w)
+            columns[6][i] = msg.twist.twist.angular.z
+        self.n += 1
+
+    def result(self):
+        if self.n == 0:
+            raise ValueError("No data found in bag for topic: ", self.topic)
+        self._fill_yaw()
+        return pd.DataFrame(
+            {name: column[:self.n] for name, column in zip(self.column_names, self.columns)},
+            copy=False
+        )
+
+    def partial(self):
+        # the time is normalized once the slices are merged
+        return StatesExtractor(self.topic, self.frenet, False, self.dtype)
+
+    def partial_result(self):
+        self._fill_yaw()
+        return [column[:self.n] for column in self.columns]
+
+    def merge(self, parts):
+        # the slices already converted their quaternions
+        self.columns = [np.concatenate(columns) for columns in zip(*parts)]
+        self.quaternions = None
+        self.n = len(self.columns[0])
+        if self.normalize_time and self.n > 0:
+            self.start_time = self.columns[0][0]
+            self.columns[0] -= self.start_time
+        return self.result()
+
+    def cache_key(self):
+        return {
+            "kind": "states",
+            "frenet": self.frenet,
+            "normalize_time": self.normalize_time,
+            "dtype": self.dtype.name,
+        }
+
+
+class WaypointsExtractor(Extractor):
+    def __init__(self, topic="/global_waypoints"):
+        super().__init__(topic)
+        self.msg = None
+        self.data = None
+
+    def add(self, msg, t):
+        self.data = []
+        for wpnt in msg.wpnts:
+            self.data.append({
+                "x": wpnt.x_m,
+                "y": wpnt.y_m,
+                "yaw": wpnt.psi_rad,
+                "vx": wpnt.vx_mps,
+                "ax": wpnt.ax_mps2,
+                "s": wpnt.s_m,
+            })
+        self.msg = msg
+        self.done = True
+
+    def result(self):
+        if self.data is None:
+            raise ValueError("No waypoints found in bag")
+        return pd.DataFrame(self.data)
+
+
+class TrackboundsExtractor(Extractor):
+    """
+    Splits the markers of the first trackbounds message into boundary loops.
+
+    A new loop starts wherever two consecutive markers are further apart
+    than sqrt(jump_sq) meters. By default the first loop is returned as
+    the exterior and all following ones as the interior, with `loops` set
+    the list of all loops is returned (e.g. for pit lanes).
+    """
+    def __init__(self, topic="/trackbounds/markers", loops=False, jump_sq=2.0):
+        super().__init__(topic)
+        self.loops = loops
+        self.jump_sq = jump_sq
+        self.positions = None
+
+    def add(self, msg, t):
+        self.positions = np.array(
+            [(m.pose.position.x, m.pose.position.y) for m in msg.markers], dtype=np.float64
+        ).reshape(-1, 2)
+        self.done = True
+
+    def result(self):
+        if self.positions is None:
+            raise ValueError("No trackbounds found in bag")
+        jumps = np.flatnonzero(np.sum(np.diff(self.positions, axis=0) ** 2, axis=1) > self.jump_sq) + 1
+        if self.loops:
+            return [pd.DataFrame(loop, columns=["x", "y"]) for loop in np.split(self.positions, jumps)]
+        split = jumps[0] if len(jumps) > 0 else len(self.positions)
+        return (
+            pd.DataFrame(self.positions[:split], columns=["x", "y"]),
+            pd.DataFrame(self.positions[split:], columns=["x", "y"])
+        )
+
+    def cache_key(self):
+        return {"kind": "trackbounds", "loops": self.loops, "jump_sq": self.jump_sq}
+
+
+class DetectionsExtractor(Extractor):
+    """
+    Collects the obstacles of all messages into flat columns and converts
+    them to cartesian coordinates with a single batched FrenetConverter call.
+    """
+    def __init__(self, fc, topic="/perception/obstacles"):
+        super().__init__(topic)
+        self.fc = fc
+        self.columns = _Columns({"id": np.int64, "time": np.float64, "s": np.float64, "d": np.float64, "vs": np.float64})
+
+    def add(self, msg, t):
+        time = msg.header.stamp.to_sec()
+        for o in msg.obstacles:
+            self.columns.append(o.id, time, (o.s_start + o.s_end) / 2, (o.d_right + o.d_left) / 2, o.vs)
+
+    def result(self):
+        columns = self.columns.arrays()
+        if len(columns["id"]) == 0:
+            return []
+        x, y = self.fc.get_cartesian(columns["s"], columns["d"])
+        df = pd.DataFrame({
+            "id": columns["id"],
+            "x": x,
+            "y": y,
+            "time": columns["time"],
+            "s": columns["s"],
+            "d": columns["d"],
+            "vs": columns["vs"],
+        })
+        # one track per obstacle id, in order of first appearance
+        return [
+            track.drop(columns="id").reset_index(drop=True)
+            for _, track in df.groupby("id", sort=False)
+        ]
+
+    def partial(self):
+        return DetectionsExtractor(self.fc, self.topic)
+
+    def partial_result(self):
+        return self.columns.arrays()
+
+    def merge(self, parts):
+        self.columns.data = [np.concatenate([part[name] for part in parts]) for name in self.columns.names]
+        self.columns.n = len(self.columns.data[0])
+        return self.result()
+
+    def cache_key(self):
+        # The converted positions depend on the raceline of the converter
+        raceline = np.concatenate([np.asarray(self.fc.waypoints_x), np.asarray(self.fc.waypoints_y)])
+        return {"kind": "detections", "raceline": hashlib.sha1(raceline.tobytes()).hexdigest()}
+
+
+class MarkersExtractor(Extractor):
+    def __init__(self, topic):
+        super().__init__(topic)
+        self.data = []
+
+    def add(self, msg, t):
+        for m in msg.markers:
+            self.data.append({
+                "x": m.pose.position.x,
+                "y": m.pose.position.y,
+            })
+
+    def result(self):
+        return pd.DataFrame(self.data)
+
+    def partial(self):
+        return MarkersExtractor(self.topic)
+
+    def partial_result(self):
+        return self.data
+
+    def merge(self, parts):
+        self.data = [marker for part in parts for marker in part]
+        return self.result()
+
+    def cache_key(self):
+        return {"kind": "markers"}
+
+
+class FieldsExtractor(Extractor):
+    """
+    Extracts dotted field paths such as "twist.twist.linear.x" from every
+    message into typed columns, next to the bag time of the message.
+
+    The paths are compiled once into a single operator.attrgetter, so no
+    string handling happens per message.
+    """
+    def __init__(self, topic, fields: List[str], dtype=np.float64):
+        super().__init__(topic)
+        self.fields = list(fields)
+        self.dtype = np.dtype(dtype)
+        self.getter = operator.attrgetter(*self.fields)
+        self.columns = self._columns(1024)
+
+    def _columns(self, capacity):
+        dtypes = {"time": np.float64}
+        dtypes.update({field: self.dtype for field in self.fields})
+        return _Columns(dtypes, capacity=max(capacity, 1))
+
+    def begin(self, bag, n):
+        self.columns = self._columns(n)
+
+    def add(self, msg, t):
+        values = self.getter(msg)
+        if len(self.fields) == 1:
+            self.columns.append(t.to_sec(), values)
+        else:
+            self.columns.append(t.to_sec(), *values)
+
+    def result(self):
+        return pd.DataFrame(self.columns.arrays(), copy=False)
+
+    def partial(self):
+        return FieldsExtractor(self.topic, self.fields, self.dtype)
+
+    def partial_result(self):
+        return self.columns.arrays()
+
+    def merge(self, parts):
+        self.columns.data = [np.concatenate([part[name] for part in parts]) for name in self.columns.names]
+        self.columns.n = len(self.columns.data[0])
+        return self.result()
+
+    def cache_key(self):
+        return {"kind": "fields", "fields": self.fields, "dtype": self.dtype.name}
+
+
+def _read_extractors(bag, extractors: Dict[str, Extractor], start_time=None, end_time=None, title=None):
+    '''
+    Feeds the messages between the genpy times `start_time` and `end_time`
+    to the extractors. No progress bar is shown without a title.
+    '''
+    by_topic = {}
+    for extractor in extractors.values():
+        by_topic.setdefault(extractor.topic, []).append(extractor)
+    topics = list(by_topic.keys())
+
+    n = 0
+    for topic, topic_extractors in by_topic.items():
+        topic_n = len(_entry_stamps(bag, [topic], start_time, end_time))
+        for extractor in topic_extractors:
+            extractor.begin(bag, topic_n)
+        n += topic_n
+    messages = bag.read_messages(topics=topics, start_time=start_time, end_time=end_time, raw=True)
+    with alive_progress.alive_bar(n, title=title, disable=title is None) as bar:
+        for topic, raw, t in messages:
+            datatype = raw[0]
+            msg = None
+            record = None
+            for extractor in by_topic[topic]:
+                if extractor.done:
+                    continue
+                if datatype in extractor.raw_types and raw_decode.can_decode(datatype):
+                    if record is None:
+                        record = raw_decode.decode(raw)
+                    extractor.add_raw(record, t)
+                else:
+                    if msg is None:
+                        msg = raw_decode.deserialize(raw)
+                    extractor.add(msg, t)
+            bar()
+            if all(extractor.done for extractor in extractors.values()):
+                break
+
+
+def _split_time_range(bag, topics, slices, start_time=None, end_time=None) -> List[Tuple[int, int]]:
+    '''
+    Splits the messages on `topics` into up to `slices` time ranges holding
+    about the same number of messages. Boundaries are moved to chunk starts
+    so no chunk has to be decompressed by two workers.
+
+    Returns:
+        List[Tuple[int, int]]: Inclusive (start, end) bag times in nanoseconds
+    '''
+    stamps = _entry_stamps(bag, topics, start_time, end_time)
+    if len(stamps) == 0:
+        return []
+    first, last = stamps[0], stamps[-1]
+    targets = stamps[(np.arange(1, slices) * len(stamps)) // slices]
+    chunk_starts = np.sort(np.array([chunk.start_time.to_nsec() for chunk in bag._chunks], dtype=np.int64))
+    if len(chunk_starts) > 0:
+        targets = chunk_starts[np.minimum(np.searchsorted(chunk_starts, targets), len(chunk_starts) - 1)]
+    bounds = np.unique(np.concatenate([[first], targets[(targets > first) & (targets <= last)], [last + 1]]))
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(len(bounds) - 1)]
+
+
+def _extract_slice(args):
+    bagpath, extractors, start_nsec, end_nsec = args
     with rosbag.Bag(bagpath) as bag:
-        n = bag.get_message_count(detection_topic)
-        with alive_progress.alive_bar(n, title="Detections") as bar:
-            data = {}
-            for _, msg, _ in bag.read_messages(topics=detection_topic):
+        _read_extractors(bag, extractors, _nsec_to_time(start_nsec), _nsec_to_time(end_nsec))
+    return {name: extractor.partial_result() for name, extractor in extractors.items()}
+
+
+def _extract_parallel(bagpath, extractors: Dict[str, Extractor], workers, start_time=None, end_time=None, title=None):
+    '''
+    Reads the time slices of a bag in worker processes and merges the
+    partial results of every extractor in time order.
+    '''
+    topics = list({extractor.topic for extractor in extractors.values()})
+    with rosbag.Bag(bagpath) as bag:
+        slices = _split_time_range(bag, topics, workers, start_time, end_time)
+    if not slices:
+        return {name: extractor.result() for name, extractor in extractors.items()}
+    tasks = [
+        (bagpath, {name: extractor.partial() for name, extractor in extractors.items()}, start, end)
+        for start, end in slices
+    ]
+    parts = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        with alive_progress.alive_bar(len(tasks), title=title) as bar:
+            for part in executor.map(_extract_slice, tasks):
+                parts.append(part)
                 bar()
-                for i, o in enumerate(msg.obstacles):
-                    opp_s = (o.s_start + o.s_end) / 2
-                    opp_d = (o.d_right + o.d_left) / 2
-                    x, y = fc.get_cartesian(opp_s, opp_d)
-                    id = o.id
-                    key = "opp" + str(id)
-                    if key in data:
-                        data[key]["x"].append(x)
-                        data[key]["y"].append(y)
-                        data[key]["time"].append(msg.header.stamp.to_sec())
-                        data[key]["s"].append(opp_s)
-                        data[key]["d"].append(opp_d)
-                        data[key]["vs"].append(o.vs)
-                    else:
-                        data[key] = {
-                            "x": [x],
-                            "y": [y],
-                            "time": [msg.header.stamp.to_sec()],
-                            "s": [opp_s],
-                            "d": [opp_d],
-                            "vs": [o.vs],
-                        }
-            return [pd.DataFrame(data[key]) for key in data.keys()]
-        print("No detections found in bag: ", bagpath)
-        raise ValueError("No detections found in bag")
+    return {name: extractor.merge([part[name] for part in parts]) for name, extractor in extractors.items()}
+
+
+def extract_from_bag(
+    bagpath: str,
+    extractors: Dict[str, Extractor],
+    title="Extracting",
+    cache=True,
+    start_time: float = None,
+    end_time: float = None,
+    workers: int = 1) -> Dict[str, Any]:
+    """
+    Runs several extractors over a rosbag in a single read pass.
+
+    The bag is opened once and `read_messages` iterates over the union of
+    all extractor topics, dispatching every message to the extractors of
+    its topic. Several extractors may share a topic. Cacheable results are
+    loaded from and stored to the bag cache if its directory exists.
+
+    Messages are read raw; fixed-layout types are decoded field-wise for
+    extractors supporting it, everything else is deserialized once per
+    message and shared between the extractors of the topic.
+
+    With `start_time`/`end_time` only messages received in that window are
+    read, seeking to it through the bag's chunk index.
+
+    With more than one worker, the time range is split into chunk-aligned
+    slices which are read by a process pool. Extractors that cannot be
+    split (e.g. those using only the first message) still run in this
+    process.
+
+    Parameters:
+        bagpath (str): The path to the rosbag file.
+        extractors (Dict[str, Extractor]): Extractors keyed by result name.
+        title (str): Title of the progress bar.
+        cache (bool): Whether to use the bag cache.
+        start_time (float): Bag time in seconds to start reading at.
+        end_time (float): Bag time in seconds to stop reading at.
+        workers (int): Number of processes reading slices of the bag.
+
+    Returns:
+        Dict[str, Any]: The result of each extractor, keyed like `extractors`.
+    """
+    results = {}
+    cache_keys = {}
+    bag_cache = BagCache()
+    if cache and bag_cache.enabled:
+        for name, extractor in extractors.items():
+            params = extractor.cache_key()
+            if params is None:
+                continue
+            params = dict(params, start_time=start_time, end_time=end_time)
+            cache_keys[name] = bag_cache.key(bagpath, extractor.topic, params)
+            cached = bag_cache.load(cache_keys[name])
+            if cached is not None:
+                results[name] = cached
+    extractors = {name: e for name, e in extractors.items() if name not in results}
+
+    serial = extractors
+    if workers > 1:
+        parallel = {name: e for name, e in extractors.items() if e.partial() is not None}
+        serial = {name: e for name, e in extractors.items() if name not in parallel}
+        if parallel:
+            results.update(_extract_parallel(
+                bagpath, parallel, workers, _to_time(start_time), _to_time(end_time), title
+            ))
+    if serial:
+        with rosbag.Bag(bagpath) as bag:
+            _read_extractors(bag, serial, _to_time(start_time), _to_time(end_time), title)
+        for name, extractor in serial.items():
+            results[name] = extractor.result()
+
+    for name in extractors:
+        if name in cache_keys:
+            bag_cache.store(cache_keys[name], results[name])
+    return results
+
+
+def extract_fields(bagpath: str, spec: Dict[str, List[str]], **kwargs) -> Dict[str, pd.DataFrame]:
+    '''
+    Extracts dotted fields of several topics in one pass over a rosbag.
+
+    Parameters:
+        bagpath (str): The path to the rosbag file.
+        spec (Dict[str, List[str]]): Field paths to extract, keyed by topic,
+            e.g. {"/car_state/odom": ["twist.twist.linear.x"]}.
+        kwargs: Passed on to extract_from_bag.
+
+    Returns:
+        Dict[str, pd.DataFrame]: A time column plus one column per field, keyed by topic.
+    '''
+    kwargs.setdefault("title", "Fields")
+    return extract_from_bag(
+        bagpath, {topic: FieldsExtractor(topic, fields) for topic, fields in spec.items()}, **kwargs
+    )
+
+
+# dtype and number of channels of the sensor_msgs/Image encodings we record
+IMAGE_ENCODINGS = {
+    "mono8": (np.uint8, 1),
+    "8UC1": (np.uint8, 1),
+    "mono16": (np.uint16, 1),
+    "16UC1": (np.uint16, 1),
+    "32FC1": (np.float32, 1),
+    "rgb8": (np.uint8, 3),
+    "bgr8": (np.uint8, 3),
+    "8UC3": (np.uint8, 3),
+    "rgba8": (np.uint8, 4),
+    "bgra8": (np.uint8, 4),
+}
+
+
+def _image_from_raw(buf) -> np.ndarray:
+    _, height, width, encoding, step, offset, length = raw_decode.image_layout(buf)
+    if encoding not in IMAGE_ENCODINGS:
+        raise ValueError("Unsupported image encoding: ", encoding)
+    dtype, channels = IMAGE_ENCODINGS[encoding]
+    dtype = np.dtype(dtype)
+    # view into the message buffer, rows may be padded up to step bytes
+    rows = np.frombuffer(buf, dtype=np.uint8, count=length, offset=offset).reshape(height, step)
+    pixels = rows[:, :width * channels * dtype.itemsize].view(dtype)
+    return pixels.reshape(height, width, channels) if channels > 1 else pixels
+
+
+def _compressed_image_from_raw(buf) -> np.ndarray:
+    import cv2
+    _, _, offset, length = raw_decode.compressed_image_layout(buf)
+    data = np.frombuffer(buf, dtype=np.uint8, count=length, offset=offset)
+    return cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+
+
+def iter_images(
+    bagpath: str,
+    image_topic: str,
+    start_time: float = None,
+    end_time: float = None,
+    fps: float = None,
+    workers: int = 4) -> Iterator[Tuple[float, np.ndarray]]:
+    '''
+    Iterate over the images of a topic as NumPy arrays.
+
+    Only one frame (or a bounded number of frames being decoded) is held
+    in memory at a time. Raw images are returned as read-only views into
+    the message buffer, copy them before modifying. Compressed images are
+    decoded with OpenCV in a thread pool.
+
+    Parameters:
+    bagpath (str): The path to the rosbag file.
+    image_topic (str): The topic to extract images from.
+    start_time (float): Bag time in seconds of the first image, defaults to the bag start.
+    end_time (float): Bag time in seconds of the last image, defaults to the bag end.
+    fps (float): If given, frames are decimated to at most this frame rate.
+    workers (int): Number of threads decoding compressed images.
+
+    Yields:
+        Tuple[float, np.ndarray]: The header stamp and the image
+    '''
+    min_dt = 1.0 / fps if fps else 0.0
+    next_time = None
+    with rosbag.Bag(bagpath) as bag, ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        messages = bag.read_messages(
+            topics=[image_topic],
+            start_time=_to_time(start_time),
+            end_time=_to_time(end_time),
+            raw=True
+        )
+        for _, raw, t in messages:
+            if next_time is not None and t.to_sec() < next_time:
+                continue
+            next_time = t.to_sec() + min_dt
+            datatype, buf = raw[0], raw[1]
+            if datatype == "sensor_msgs/CompressedImage":
+                stamp = raw_decode.compressed_image_layout(buf)[0]
+                pending.append((stamp, executor.submit(_compressed_image_from_raw, buf)))
+                if len(pending) >= 2 * workers:
+                    stamp, future = pending.popleft()
+                    yield stamp, future.result()
+            elif datatype == "sensor_msgs/Image":
+                yield raw_decode.image_layout(buf)[0], _image_from_raw(buf)
+            else:
+                raise ValueError("Not an image topic: ", image_topic)
+        while pending:
+            stamp, future = pending.popleft()
+            yield stamp, future.result()
+
+
+def get_detections_from_bag(
+    bagpath,
+    fc,
+    detection_topic="/perception/obstacles",
+    start_time=None,
+    end_time=None,
+    workers=1):
+    return extract_from_bag(
+        bagpath,
+        {"detections": DetectionsExtractor(fc, detection_topic)},
+        title="Detections",
+        start_time=start_time,
+        end_time=end_time,
+        workers=workers
+    )["detections"]
 
 def get_trackbounds_from_bag(bagpath, trackbounds_topic="/trackbounds/markers"):
-    exterior = []
-    interior = []
-    switched = False
-    old_pos = None
-    with rosbag.Bag(bagpath) as bag:
-        for _, msg, _ in bag.read_messages(topics=trackbounds_topic):
-            n = len(msg.markers)
-            with alive_progress.alive_bar(n, title="Trackbounds") as bar:
-                for bound in msg.markers:
-                    bar()
-                    if switched:
-                        interior.append({
-                            "x": bound.pose.position.x,
-                            "y": bound.pose.position.y,
-                        })
-                    else:
-                        x = bound.pose.position.x
-                        y = bound.pose.position.y
-                        if old_pos is not None:
-                            if (old_pos[0] - x) ** 2 + (old_pos[1] - y) ** 2 > 2.0:
-                                switched = True
-                                interior.append({
-                                    "x": x,
-                                    "y": y,
-                                })
-                                continue
-                        old_pos = (x, y)
-                        exterior.append({
-                            "x": x,
-                            "y": y,
-                        })
-            
-                return pd.DataFrame(exterior), pd.DataFrame(interior)
-            
+    try:
+        return extract_from_bag(
+            bagpath, {"trackbounds": TrackboundsExtractor(trackbounds_topic)}, title="Trackbounds"
+        )["trackbounds"]
+    except ValueError:
         print("No trackbounds found in bag: ", bagpath)
-        raise ValueError("No trackbounds found in bag")
+        raise
+
+def get_trackbound_loops(bagpath, trackbounds_topic="/trackbounds/markers") -> List[pd.DataFrame]:
+    '''
+    Get every closed boundary loop of the track, e.g. exterior, interior and pit lane.
+    '''
+    return extract_from_bag(
+        bagpath, {"trackbounds": TrackboundsExtractor(trackbounds_topic, loops=True)}, title="Trackbounds"
+    )["trackbounds"]
 
 def get_waypoints_from_bag(bagpath, waypoints_topic="/global_waypoints"):
-    with rosbag.Bag(bagpath) as bag:
-        for _, msg, _ in bag.read_messages(topics=waypoints_topic):
-            data = []
-            for wpnt in msg.wpnts:
-                data.append({
-                    "x": wpnt.x_m,
-                    "y": wpnt.y_m,
-                    "yaw": wpnt.psi_rad,
-                    "vx": wpnt.vx_mps,
-                    "ax": wpnt.ax_mps2,
-                    "s": wpnt.s_m,
-                })
-            return pd.DataFrame(data), msg
+    extractor = WaypointsExtractor(waypoints_topic)
+    try:
+        df = extract_from_bag(bagpath, {"waypoints": extractor}, title="Waypoints")["waypoints"]
+    except ValueError:
         print("No waypoints found in bag: ", bagpath)
-        raise ValueError("No waypoints found in bag")
+        raise
+    return df, extractor.msg
 
-def get_states_from_bag(bagpath, odom_topic="/car_state/odom", frenet=False, normalize_time=False):
+def get_states_from_bag(
+    bagpath,
+    odom_topic="/car_state/odom",
+    frenet=False,
+    normalize_time=False,
+    dtype=np.float64,
+    start_time=None,
+    end_time=None,
+    workers=1):
     """
     Get a pandas DataFrame from a rosbag.
 
     Parameters:
         bag (rosbag.Bag): The rosbag to extract data from.
+        dtype: dtype of all columns except time, e.g. np.float32 to halve memory.
+        start_time (float): Bag time in seconds to start reading at.
+        end_time (float): Bag time in seconds to stop reading at.
+        workers (int): Number of processes reading slices of the bag in parallel.
 
     Returns:
         pd.DataFrame: The extracted data.
     """
-    if frenet:
-        data = {
-            'time': [],
-            's': [],
-            'd': [],
-            'vs': []
-        }
-    else:
-        data = {
-            'time': [],
-            'position_x': [],
-            'position_y': [],
-            'velocity_x': [],
-            'velocity_y': [],
-            'yaw': [],
-            'yaw_rate': []
-        }
-    column_names = list(data.keys())
-    start_time = 0
-    with rosbag.Bag(bagpath) as bag:
-        n = bag.get_message_count(odom_topic)
-        with alive_progress.alive_bar(n, title="Getting states") as bar:
-            for _, msg, _ in bag.read_messages(topics=[odom_topic]):
-                if normalize_time and start_time == 0:
-                    start_time = msg.header.stamp.to_sec()
-                data[column_names[0]].append(msg.header.stamp.to_sec() - start_time)
-                data[column_names[1]].append(msg.pose.pose.position.x)
-                data[column_names[2]].append(msg.pose.pose.position.y)
-                data[column_names[3]].append(msg.twist.twist.linear.x)
-                if not frenet:
-                    data[column_names[4]].append(msg.twist.twist.linear.y)
-                    data[column_names[5]].append(get_yaw(msg))
-                    data[column_names[6]].append(msg.twist.twist.angular.z)
-                bar()
-    if len(data[column_names[0]]) == 0:
-        raise ValueError("No data found in bag for topic: ", odom_topic)
-    return pd.DataFrame(data)
+    return extract_from_bag(
+        bagpath,
+        {"states": StatesExtractor(odom_topic, frenet, normalize_time, dtype)},
+        title="Getting states",
+        start_time=start_time,
+        end_time=end_time,
+        workers=workers
+    )["states"]
@@ -0,0 +1,148 @@
+import math
+import numpy as np
+from typing import Dict
+
+'''
+    Constant memory accumulators for the error statistics of arbitrarily long
+    runs. They are updated with batches of samples and can be merged, e.g.
+    across blocks of a bag or across bags.
+'''
+
+
+class RunningStats:
+    '''
+    Count, mean and variance (Welford, batched with the update of Chan et al.),
+    mean square, min and max of a stream of values.
+    '''
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sum_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        batch = RunningStats()
+        batch.n = len(values)
+        batch.mean = float(np.mean(values))
+        batch.m2 = float(np.sum((values - batch.mean) ** 2))
+        batch.sum_sq = float(np.sum(values ** 2))
+        batch.min = float(np.min(values))
+        batch.max = float(np.max(values))
+        self.merge(batch)
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta ** 2 * self.n * other.n / n
+        self.sum_sq += other.sum_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.n = n
+
+    @property
+    def variance(self):
+        return self.m2 / self.n if self.n > 0 else np.nan
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance) if self.n > 0 else np.nan
+
+    @property
+    def rms(self):
+        return math.sqrt(self.sum_sq / self.n) if self.n > 0 else np.nan
+
+
+class QuantileSketch:
+    '''
+    Quantiles of the magnitudes of a stream of values with a bounded relative
+    error, using logarithmically spaced buckets (DDSketch, Masson et al. 2019).
+    Magnitudes below min_value share one bucket and are reported as 0.
+
+    Parameters:
+    relative_accuracy (float): Bound on the relative error of every quantile.
+    min_value (float): Smallest magnitude that is resolved.
+    '''
+    def __init__(self, relative_accuracy=0.01, min_value=1e-9):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.key_offset = int(math.floor(math.log(min_value) / self.log_gamma))
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.zero_count = 0
+        self.n = 0
+
+    def update(self, values):
+        values = np.abs(np.asarray(values, dtype=np.float64).ravel())
+        values = values[np.isfinite(values)]
+        small = values < self.min_value
+        self.zero_count += int(np.count_nonzero(small))
+        # bucket k holds the values in (gamma^(k - 1), gamma^k]
+        keys = np.ceil(np.log(values[~small]) / self.log_gamma).astype(np.int64) - self.key_offset
+        if len(keys) > 0:
+            counts = np.bincount(keys, minlength=len(self.counts))
+            counts[:len(self.counts)] += self.counts
+            self.counts = counts
+        self.n += len(values)
+
+    def merge(self, other):
+        if other.gamma != self.gamma or other.min_value != self.min_value:
+            raise ValueError("Cannot merge sketches with different parameters: ", other.gamma)
+        counts = np.zeros(max(len(self.counts), len(other.counts)), dtype=np.int64)
+        counts[:len(self.counts)] += self.counts
+        counts[:len(other.counts)] += other.counts
+        self.counts = counts
+        self.zero_count += other.zero_count
+        self.n += other.n
+
+    def quantile(self, q) -> float:
+        if self.n == 0:
+            return np.nan
+        rank = q * (self.n - 1)
+        if rank < self.zero_count:
+            return 0.0
+        cumulative = self.zero_count + np.cumsum(self.counts)
+        key = min(int(np.searchsorted(cumulative, rank, side="right")), len(self.counts) - 1)
+        return 2 * self.gamma ** (key + self.key_offset) / (self.gamma + 1)
+
+
+class ErrorAccumulator:
+    '''
+    Streaming counterpart of trajectory_error.error_statistics, the sign of
+    the errors is ignored. The median has the relative accuracy of the sketch,
+    all other statistics are exact.
+    '''
+    def __init__(self, relative_accuracy=0.01):
+        self.stats = RunningStats()
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def update(self, errors):
+        errors = np.abs(np.asarray(errors, dtype=np.float64))
+        self.stats.update(errors)
+        self.sketch.update(errors)
+
+    def merge(self, other):
+        self.stats.merge(other.stats)
+        self.sketch.merge(other.sketch)
+
+    def quantile(self, q) -> float:
+        return self.sketch.quantile(q)
+
+    def statistics(self) -> Dict[str, float]:
+        if self.stats.n == 0:
+            return {key: np.nan for key in ["rmse", "mean", "median", "std", "min", "max"]}
+        return {
+            "rmse": self.stats.rms,
+            "mean": self.stats.mean,
+            "median": self.quantile(0.5),
+            "std": self.stats.std,
+            "min": self.stats.min,
+            "max": self.stats.max,
+        }
@@ -0,0 +1,192 @@
+import numpy as np
+from typing import Tuple
+
+'''
+    Matching of timestamps between two time series, e.g. an estimator and
+    its ground truth. All functions work on whole arrays at once and expect
+    the reference times to be sorted.
+'''
+
+
+def nearest_indices(query_times, reference_times, max_dt=np.inf) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Finds the nearest reference sample for every query time.
+
+    Parameters:
+    query_times (np.array): Times to match.
+    reference_times (np.array): Sorted times to match against.
+    max_dt (float): Matches further apart than this are invalid.
+
+    Returns:
+        indices (np.array): Index of the nearest reference sample per query.
+        valid (np.array): Mask of the queries with a match within max_dt.
+    '''
+    query_times = np.asarray(query_times, dtype=np.float64)
+    reference_times = np.asarray(reference_times, dtype=np.float64)
+    if len(reference_times) == 0:
+        return np.zeros(len(query_times), dtype=np.int64), np.zeros(len(query_times), dtype=bool)
+
+    right = np.clip(np.searchsorted(reference_times, query_times), 1, len(reference_times) - 1)
+    left = right - 1
+    if len(reference_times) == 1:
+        right = left = np.zeros_like(right)
+    use_left = np.abs(query_times - reference_times[left]) <= np.abs(reference_times[right] - query_times)
+    indices = np.where(use_left, left, right)
+    valid = np.abs(reference_times[indices] - query_times) <= max_dt
+    return indices, valid
+
+
+def bracketing_indices(query_times, reference_times, max_dt=np.inf) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Finds the reference samples enclosing every query time.
+
+    Returns:
+        indices (np.array): Index of the sample before (or at) each query.
+        fractions (np.array): Position of the query between sample i and i + 1, in [0, 1].
+        valid (np.array): Mask of the queries inside the reference range whose
+            enclosing samples are both within max_dt.
+    '''
+    query_times = np.asarray(query_times, dtype=np.float64)
+    reference_times = np.asarray(reference_times, dtype=np.float64)
+    if len(reference_times) < 2:
+        indices, valid = nearest_indices(query_times, reference_times, max_dt)
+        return indices, np.zeros(len(query_times)), valid & (len(reference_times) == 1)
+
+    indices = np.clip(np.searchsorted(reference_times, query_times, side="right") - 1, 0, len(reference_times) - 2)
+    t0 = reference_times[indices]
+    t1 = reference_times[indices + 1]
+    span = t1 - t0
+    fractions = np.clip(np.divide(query_times - t0, span, out=np.zeros_like(span), where=span > 0), 0.0, 1.0)
+    valid = (
+        (query_times >= reference_times[0]) & (query_times <= reference_times[-1])
+        & (query_times - t0 <= max_dt) & (t1 - query_times <= max_dt)
+    )
+    return indices, fractions, valid
+
+
+def interpolate_linear(query_times, reference_times, values, max_dt=np.inf) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Linearly interpolates (N,) or (N, k) values at the query times.
+
+    Returns:
+        values (np.array): The interpolated values, one row per query.
+        valid (np.array): See bracketing_indices.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    indices, fractions, valid = bracketing_indices(query_times, reference_times, max_dt)
+    if len(values) < 2:
+        return values[indices], valid
+    if values.ndim > 1:
+        fractions = fractions[:, None]
+    return values[indices] * (1 - fractions) + values[indices + 1] * fractions, valid
+
+
+def slerp(query_times, reference_times, quaternions, max_dt=np.inf) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Spherical linear interpolation of (N, 4) quaternions at the query times.
+    The component order does not matter as long as it is consistent.
+
+    Returns:
+        quaternions (np.array): The interpolated unit quaternions, one row per query.
+        valid (np.array): See bracketing_indices.
+    '''
+    quaternions = np.asarray(quaternions, dtype=np.float64)
+    indices, fractions, valid = bracketing_indices(query_times, reference_times, max_dt)
+    if len(quaternions) < 2:
+        return quaternions[indices], valid
+    q0 = quaternions[indices]
+    q1 = quaternions[indices + 1]
+    # take the shorter arc
+    dot = np.sum(q0 * q1, axis=1)
+    q1 = np.where(dot[:, None] < 0, -q1, q1)
+    dot = np.clip(np.abs(dot), -1.0, 1.0)
+
+    theta = np.arccos(dot)
+    sin_theta = np.sin(theta)
+    # fall back to linear interpolation for nearly identical rotations
+    close = sin_theta < 1e-6
+    safe_sin = np.where(close, 1.0, sin_theta)
+    w0 = np.where(close, 1 - fractions, np.sin((1 - fractions) * theta) / safe_sin)
+    w1 = np.where(close, fractions, np.sin(fractions * theta) / safe_sin)
+    result = q0 * w0[:, None] + q1 * w1[:, None]
+    return result / np.linalg.norm(result, axis=1)[:, None], valid
+
+
+def _finite_rows(times, signal):
+    times = np.asarray(times, dtype=np.float64)
+    signal = np.asarray(signal, dtype=np.float64).reshape(len(times), -1)
+    keep = np.isfinite(times) & np.all(np.isfinite(signal), axis=1)
+    return times[keep], signal[keep]
+
+
+def _offset_mse(offsets, times, signal, gt_times, gt_signal, max_values=2000000) -> np.ndarray:
+    # mean squared error against the shifted ground truth, in chunks of offsets to bound memory
+    mse = np.empty(len(offsets))
+    chunk = max(max_values // max(len(times), 1), 1)
+    for i in range(0, len(offsets), chunk):
+        shifted = times[None, :] - offsets[i:i + chunk, None]
+        inside = (shifted >= gt_times[0]) & (shifted <= gt_times[-1])
+        squared = np.zeros(shifted.shape)
+        for c in range(signal.shape[1]):
+            squared += (np.interp(shifted, gt_times, gt_signal[:, c]) - signal[None, :, c]) ** 2
+        mse[i:i + chunk] = np.sum(squared * inside, axis=1) / np.maximum(np.sum(inside, axis=1), 1)
+    return mse
+
+
+def estimate_time_offset(
+    est_times,
+    est_signal,
+    gt_times,
+    gt_signal,
+    max_offset=0.5,
+    candidates=41,
+    max_refine_samples=20000) -> float:
+    '''
+    Estimates the constant latency of an estimate with respect to its ground
+    truth, such that est(t) ~ gt(t - offset).
+
+    The signals should not depend on the frame of the trajectories, e.g.
+    speed and yaw rate. The offset minimizes the RMSE of the estimate against
+    the interpolated ground truth. It is searched over the whole range of
+    +-max_offset in steps of the sampling period, and then refined around the
+    best step, evaluating many offsets at once.
+
+    Parameters:
+    est_times, gt_times (np.array): Sorted sample times.
+    est_signal, gt_signal (np.array): (N,) or (N, k) signals, rows with NaNs are ignored.
+    max_offset (float): Largest offset in seconds considered, in either direction.
+    candidates (int): Number of offsets tried during refinement.
+    max_refine_samples (int): Estimate samples used in the search.
+
+    Returns:
+        float: The offset in seconds, positive if the estimate lags behind.
+    '''
+    est_times, est_signal = _finite_rows(est_times, est_signal)
+    gt_times, gt_signal = _finite_rows(gt_times, gt_signal)
+    if len(est_times) < 2 or len(gt_times) < 2:
+        raise ValueError("Signals overlap for less than twice the maximum offset")
+    start = max(est_times[0], gt_times[0])
+    end = min(est_times[-1], gt_times[-1])
+    if end - start <= 2 * max_offset:
+        raise ValueError("Signals overlap for less than twice the maximum offset")
+
+    # normalize every channel so they contribute equally
+    scale = np.std(gt_signal, axis=0)
+    scale[scale == 0] = 1.0
+    est_signal = (est_signal - np.mean(gt_signal, axis=0)) / scale
+    gt_signal = (gt_signal - np.mean(gt_signal, axis=0)) / scale
+
+    step = max(len(est_times) // max_refine_samples, 1)
+    times = est_times[::step]
+    signal = est_signal[::step]
+    dt = min(np.median(np.diff(est_times)), np.median(np.diff(gt_times)))
+
+    # coarse search over the whole range
+    steps = max(int(np.ceil(max_offset / dt)), 1)
+    offsets = np.linspace(-max_offset, max_offset, 2 * steps + 1)
+    coarse = offsets[np.argmin(_offset_mse(offsets, times, signal, gt_times, gt_signal))]
+
+    # refine between the neighbouring coarse offsets
+    spacing = offsets[1] - offsets[0]
+    offsets = np.clip(coarse + np.linspace(-spacing, spacing, candidates), -max_offset, max_offset)
+    return float(offsets[np.argmin(_offset_mse(offsets, times, signal, gt_times, gt_signal))])
@@ -0,0 +1,244 @@
+import numpy as np
+from typing import Dict, Tuple
+from utils.math import wrap_angle
+
+'''
+    Trajectory error metrics on time-aligned estimate and ground truth arrays.
+
+    ATE: absolute trajectory error after a closed-form (Umeyama) alignment
+    of the estimate onto the ground truth.
+    RPE: relative pose error of the motion over windows of a fixed travelled
+    distance or duration, independent of any drift before the window.
+'''
+
+ALIGNMENTS = ["se2", "se3", "sim3", None]
+
+
+def umeyama_alignment(source: np.ndarray, target: np.ndarray, with_scale=False) -> Tuple[np.ndarray, np.ndarray, float]:
+    '''
+    Least squares similarity transform mapping source onto target points,
+    S. Umeyama, "Least-squares estimation of transformation parameters
+    between two point patterns", 1991.
+
+    Parameters:
+    source (np.array): (N, d) points.
+    target (np.array): (N, d) corresponding points.
+    with_scale (bool): Also estimate a scale factor.
+
+    Returns:
+        rotation (d, d), translation (d,) and scale, such that
+        target ~ scale * rotation @ source + translation
+    '''
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    n = len(source)
+    mean_source = source.mean(axis=0)
+    mean_target = target.mean(axis=0)
+    source_centered = source - mean_source
+    target_centered = target - mean_target
+
+    covariance = target_centered.T @ source_centered / n
+    variance = np.sum(source_centered ** 2) / n
+    rotation, scale = _rotation_from_covariance(covariance, variance, with_scale)
+    translation = mean_target - scale * rotation @ mean_source
+    return rotation, translation, scale
+
+
+def _rotation_from_covariance(covariance, source_variance, with_scale) -> Tuple[np.ndarray, float]:
+    u, d, vt = np.linalg.svd(covariance)
+    signs = np.ones(len(d))
+    if np.linalg.det(u) * np.linalg.det(vt) < 0:
+        signs[-1] = -1
+    rotation = u @ np.diag(signs) @ vt
+    scale = np.sum(d * signs) / source_variance if with_scale else 1.0
+    return rotation, scale
+
+
+def align_trajectory(est_xyz, est_yaw, gt_xyz, alignment="se2") -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Aligns the estimated positions and yaws onto the ground truth.
+
+    Parameters:
+    est_xyz (np.array): (N, 2) or (N, 3) estimated positions.
+    est_yaw (np.array): (N,) estimated yaws.
+    gt_xyz (np.array): Corresponding ground truth positions.
+    alignment (str): "se2" (planar), "se3", "sim3" (with scale) or None.
+
+    Returns:
+        The aligned positions and yaws.
+    '''
+    if alignment not in ALIGNMENTS:
+        raise ValueError("Unknown alignment: ", alignment)
+    est_xyz = np.asarray(est_xyz, dtype=np.float64)
+    est_yaw = np.asarray(est_yaw, dtype=np.float64)
+    if alignment is None:
+        return est_xyz, est_yaw
+    dims = 2 if alignment == "se2" else est_xyz.shape[1]
+    rotation, translation, scale = umeyama_alignment(
+        est_xyz[:, :dims], np.asarray(gt_xyz)[:, :dims], with_scale=alignment == "sim3"
+    )
+    aligned = est_xyz.copy()
+    aligned[:, :dims] = scale * est_xyz[:, :dims] @ rotation.T + translation
+    return aligned, wrap_angle(est_yaw + np.arctan2(rotation[1, 0], rotation[0, 0]))
+
+
+def absolute_trajectory_error(est_xyz, est_yaw, gt_xyz, gt_yaw, alignment="se2") -> Dict[str, np.ndarray]:
+    '''
+    Per-sample absolute trajectory error after aligning the estimate.
+
+    Returns:
+        Dict with the "translation" [m] and "yaw" [rad] error of every sample
+    '''
+    aligned, aligned_yaw = align_trajectory(est_xyz, est_yaw, gt_xyz, alignment)
+    dims = 2 if alignment == "se2" else aligned.shape[1]
+    return {
+        "translation": np.linalg.norm(aligned[:, :dims] - np.asarray(gt_xyz)[:, :dims], axis=1),
+        "yaw": wrap_angle(aligned_yaw - gt_yaw),
+    }
+
+
+def relative_pose_error(times, est_xy, est_yaw, gt_xy, gt_yaw, delta=1.0, unit="m") -> Dict[str, np.ndarray]:
+    '''
+    Planar relative pose error over windows of `delta` meters travelled
+    (unit "m", measured on the ground truth) or `delta` seconds (unit "s").
+
+    Returns:
+        Dict with the start "index" of every window and the "translation" [m]
+        and "yaw" [rad] error of the relative motion over it
+    '''
+    est_xy = np.asarray(est_xy, dtype=np.float64)[:, :2]
+    gt_xy = np.asarray(gt_xy, dtype=np.float64)[:, :2]
+    est_yaw = np.asarray(est_yaw, dtype=np.float64)
+    gt_yaw = np.asarray(gt_yaw, dtype=np.float64)
+    if unit == "m":
+        steps = np.linalg.norm(np.diff(gt_xy, axis=0), axis=1)
+        progress = np.concatenate([[0.0], np.cumsum(steps)])
+    elif unit == "s":
+        progress = np.asarray(times, dtype=np.float64)
+    else:
+        raise ValueError("Unknown RPE unit: ", unit)
+
+    # end of the window starting at every sample
+    start = np.arange(len(progress))
+    end = np.searchsorted(progress, progress + delta)
+    start = start[end < len(progress)]
+    end = end[end < len(progress)]
+
+    def local_motion(xy, yaw):
+        # displacement expressed in the frame of the window start
+        d = xy[end] - xy[start]
+        c = np.cos(yaw[start])
+        s = np.sin(yaw[start])
+        return np.stack([c * d[:, 0] + s * d[:, 1], -s * d[:, 0] + c * d[:, 1]], axis=1), yaw[end] - yaw[start]
+
+    est_motion, est_rotation = local_motion(est_xy, est_yaw)
+    gt_motion, gt_rotation = local_motion(gt_xy, gt_yaw)
+    return {
+        "index": start,
+        "translation": np.linalg.norm(est_motion - gt_motion, axis=1),
+        "yaw": wrap_angle(est_rotation - gt_rotation),
+    }
+
+
+class AteAccumulator:
+    '''
+    Streaming absolute trajectory error RMSE with the alignment of the whole
+    run, in constant memory. The alignment and the residual of the aligned
+    positions follow in closed form from the first and second moments of the
+    corresponding points. The yaw errors before alignment are summed in
+    YAW_BINS bins over [-pi, pi), which are rotated at the end, so only the
+    bin that wraps around after the rotation is approximate.
+
+    Parameters:
+    alignment (str): See align_trajectory.
+    '''
+    YAW_BINS = 3600
+
+    def __init__(self, alignment="se2"):
+        if alignment not in ALIGNMENTS:
+            raise ValueError("Unknown alignment: ", alignment)
+        self.alignment = alignment
+        self.n = 0
+        self.yaw_counts = np.zeros(self.YAW_BINS)
+        self.yaw_sums = np.zeros(self.YAW_BINS)
+        self.yaw_sq_sums = np.zeros(self.YAW_BINS)
+
+    def update(self, est_xyz, est_yaw, gt_xyz, gt_yaw):
+        est_xyz = np.asarray(est_xyz, dtype=np.float64)
+        gt_xyz = np.asarray(gt_xyz, dtype=np.float64)
+        if len(est_xyz) == 0:
+            return
+        dims = 2 if self.alignment == "se2" else est_xyz.shape[1]
+        if self.n == 0:
+            # moments around the first ground truth point, to avoid cancellation
+            self.origin = gt_xyz[0, :dims].copy()
+            self.sum_source = np.zeros(dims)
+            self.sum_target = np.zeros(dims)
+            self.sum_cross = np.zeros((dims, dims))
+            self.sum_sq_source = 0.0
+            self.sum_sq_target = 0.0
+        source = est_xyz[:, :dims] - self.origin
+        target = gt_xyz[:, :dims] - self.origin
+        self.sum_source += source.sum(axis=0)
+        self.sum_target += target.sum(axis=0)
+        self.sum_cross += target.T @ source
+        self.sum_sq_source += np.sum(source ** 2)
+        self.sum_sq_target += np.sum(target ** 2)
+        self.n += len(source)
+
+        yaw_error = wrap_angle(np.asarray(est_yaw, dtype=np.float64) - gt_yaw)
+        bins = ((yaw_error + np.pi) / (2 * np.pi) * self.YAW_BINS).astype(np.int64)
+        bins = np.clip(bins, 0, self.YAW_BINS - 1)
+        self.yaw_counts += np.bincount(bins, minlength=self.YAW_BINS)
+        self.yaw_sums += np.bincount(bins, yaw_error, minlength=self.YAW_BINS)
+        self.yaw_sq_sums += np.bincount(bins, yaw_error ** 2, minlength=self.YAW_BINS)
+
+    def rmse(self) -> Tuple[float, float]:
+        '''
+        Returns:
+            The translation [m] and yaw [rad] RMSE after alignment
+        '''
+        if self.n == 0:
+            return np.nan, np.nan
+        mean_source = self.sum_source / self.n
+        mean_target = self.sum_target / self.n
+        source_variance = self.sum_sq_source / self.n - mean_source @ mean_source
+        target_variance = self.sum_sq_target / self.n - mean_target @ mean_target
+        covariance = self.sum_cross / self.n - np.outer(mean_target, mean_source)
+        if self.alignment is None:
+            rotation = np.eye(len(mean_source))
+            scale = 1.0
+            offset = mean_target - mean_source
+        else:
+            rotation, scale = _rotation_from_covariance(
+                covariance, source_variance, self.alignment == "sim3"
+            )
+            offset = np.zeros(len(mean_source))
+        mse = (
+            scale ** 2 * source_variance + target_variance
+            - 2 * scale * np.sum(rotation * covariance) + offset @ offset
+        )
+
+        angle = np.arctan2(rotation[1, 0], rotation[0, 0])
+        centers = -np.pi + (np.arange(self.YAW_BINS) + 0.5) * 2 * np.pi / self.YAW_BINS
+        # shift of every bin, including the wrap around
+        shift = wrap_angle(centers + angle) - centers
+        yaw_mse = np.sum(self.yaw_sq_sums + 2 * shift * self.yaw_sums + shift ** 2 * self.yaw_counts) / self.n
+        return float(np.sqrt(max(mse, 0.0))), float(np.sqrt(yaw_mse))
+
+
+def error_statistics(errors: np.ndarray) -> Dict[str, float]:
+    '''
+    Summary statistics of per-sample errors, the sign is ignored.
+    '''
+    errors = np.abs(np.asarray(errors, dtype=np.float64))
+    if len(errors) == 0:
+        return {key: np.nan for key in ["rmse", "mean", "median", "std", "min", "max"]}
+    return {
+        "rmse": float(np.sqrt(np.mean(errors ** 2))),
+        "mean": float(np.mean(errors)),
+        "median": float(np.median(errors)),
+        "std": float(np.std(errors)),
+        "min": float(np.min(errors)),
+        "max": float(np.max(errors)),
+    }
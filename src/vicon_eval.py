@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 import math
+import numpy as np
 import rosbag
+import genpy
 import matplotlib.pyplot as plt
 import pandas as pd
-from tf.transformations import euler_from_quaternion
 import os
 import shutil
 from alive_progress import alive_bar
+from utils import raw_decode
+from utils.parallel import map_bags
+from utils.math import quaternions_to_yaw, wrap_angle
+from utils.kinematics import body_velocities
+from utils.streaming_stats import ErrorAccumulator
+from utils.trajectory_error import absolute_trajectory_error, relative_pose_error, error_statistics, AteAccumulator
+from utils.time_alignment import nearest_indices, interpolate_linear, slerp, estimate_time_offset
 
 plt.rcParams.update({'font.size': 26})
 # VICON_TOPIC = '/vicon/CarNew/CarNew'
@@ -16,163 +24,359 @@ PLOT = True
 PATH_ROOT = '/home/moe/data/carla/npc_eval/'
 MAX_DT = 0.1
 
-VEL_ALPHA = 0.1
+# Velocities of the ground truth (and of estimates without a twist) are
+# differentiated with 'savgol' or 'central' and optionally low-pass filtered
+VEL_METHOD = 'savgol'
+VEL_WINDOW = 0.2
+VEL_CUTOFF = None
 
 BAGS = [
     'npc_carla.bag',
 ]
 
 RESULTS_PATH = "carla_npc"
+# Number of bags evaluated in parallel, None uses all cores
+WORKERS = None
 NORMALIZE = True
+# Alignment of the estimate before computing the ATE: 'se2', 'se3', 'sim3' or None
+ALIGNMENT = 'se2'
+# RPE window, in meters travelled ('m') or seconds ('s')
+RPE_DELTA = 1.0
+RPE_UNIT = 'm'
+# Estimate and remove a constant odom latency of up to MAX_OFFSET seconds, on both series decimated to OFFSET_DT
+ESTIMATE_OFFSET = True
+MAX_OFFSET = 0.5
+OFFSET_DT = 0.02
+# When streaming, the latency is estimated on OFFSET_WINDOWS windows spread over the run,
+# together OFFSET_SAMPLES * OFFSET_DT seconds long, or on the whole run if it is shorter
+OFFSET_SAMPLES = 20000
+OFFSET_WINDOWS = 20
+# Interpolate the ground truth at the odom timestamps (linear + SLERP) instead of taking the nearest sample
+INTERPOLATE = True
+# Evaluate in bounded memory, block by block, when nothing is plotted
+STREAM = not PLOT
+# Seconds of bag time read per block when streaming
+STREAM_BLOCK = 30.0
 overall_dt = 0
 
 
 class TfBuffer:
-    def __init__(self, topic_name, bag_path):
-        self.bag_path = bag_path
-        self.buffer = []
-        self.curr_index = 0
-
-        # read into_buffer
-        with rosbag.Bag(bag_path) as vicon_bag:
-            for _, msg, t in vicon_bag.read_messages(topics=[topic_name]):
-                self.buffer.append((msg, t.to_sec()))
-
-
-    def get_transform_at_time(self, time):
-        global overall_dt
-        if time < self.buffer[0][1] - MAX_DT:
-            return None
-        if time > self.buffer[-1][1] + MAX_DT:
-            return None
-        low_index = max(self.curr_index - 50, 0)
-        high_index = min(self.curr_index + 50, len(self.buffer) - 1)
-        small_buff = self.buffer[low_index : high_index]
-        self.curr_index =  self.buffer.index(min(small_buff, key=lambda x: abs(x[1] - time)))
-        if abs(time - self.buffer[self.curr_index][1]) > MAX_DT:
-            return None
-        overall_dt += abs(self.buffer[self.curr_index][1] - time)
-        return self.buffer[self.curr_index][0]
-
-def get_yaw(msg, vicon=False):
-    if not vicon:
-        return euler_from_quaternion([
-            msg.pose.orientation.x,
-            msg.pose.orientation.y,
-            msg.pose.orientation.z,
-            msg.pose.orientation.w])[2]
-    else:
-        return euler_from_quaternion([
-            msg.transform.rotation.x,
-            msg.transform.rotation.y,
-            msg.transform.rotation.z,
-            msg.transform.rotation.w])[2]
+    """
+    Columnar store of the samples of one topic: one contiguous float64 row per field, preallocated
+    and filled once while reading the bag. Every evaluation pass works on views of the same arrays.
+    """
+    # bag time, followed by the fields of the decoded records
+    FIELDS = ["time", "stamp", "x", "y", "z", "qx", "qy", "qz", "qw", "vx", "vy", "vz", "wx", "wy", "wz"]
 
-def evaluate_bag(bag_path):
-    x_init = 0
-    y_init = 0
-    yaw_init = 0
-    vicon_x_init = 0
-    vicon_y_init = 0
-    vicon_yaw_init = 0
-    init = False
-    error_x = 0
-    error_vx = 0
-    error_yaw = 0
-    error_y = 0
-    error_vy = 0
-    error_vyaw = 0
-    tf_buffer = TfBuffer(VICON_TOPIC, bag_path)
-    i = 0
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.fields = self.FIELDS[:9]
+        self.columns = np.empty((len(self.fields), 0))
+        self.yaws = np.empty(0)
+        self.n = 0
+
+    def append(self, time, record):
+        if self.n == self.columns.shape[1]:
+            self._grow(len(record))
+        self.columns[:, self.n] = (time,) + tuple(record)
+        self.n += 1
+
+    def _grow(self, record_length):
+        if self.n == 0:
+            # odometry records also have a twist
+            self.fields = self.FIELDS[:1 + record_length]
+            self.columns = np.empty((len(self.fields), max(self.capacity, 1024)))
+            return
+        columns = np.empty((len(self.fields), 2 * self.columns.shape[1]))
+        columns[:, :self.n] = self.columns[:, :self.n]
+        self.columns = columns
+
+    def finish(self):
+        """
+        Releases the unused capacity and computes the yaws, call once after the last append.
+        """
+        if self.columns.shape[1] != self.n:
+            self.columns = self.columns[:, :self.n].copy()
+        self.yaws = quaternions_to_yaw(self.quaternions)
+        return self
+
+    @property
+    def times(self):
+        return self.columns[0]
+
+    @property
+    def stamps(self):
+        return self.columns[1]
+
+    @property
+    def xy(self):
+        return self.columns[2:4].T
+
+    @property
+    def xyz(self):
+        return self.columns[2:5].T
+
+    @property
+    def quaternions(self):
+        return self.columns[5:9].T
+
+    @property
+    def twists(self):
+        """
+        (N, 6) vx, vy, vz, wx, wy, wz in the body frame, None if the messages have no twist.
+        """
+        return self.columns[9:15].T if len(self.fields) > 9 else None
+
+    def get_velocities(self):
+        """
+        Body frame vx, vy and yaw rate of every sample, differentiated from the poses if there is no twist.
+        """
+        if self.twists is not None:
+            return self.twists[:, [0, 1, 5]]
+        return np.column_stack(body_velocities(
+            self.times, self.xy, self.yaws, VEL_METHOD, VEL_WINDOW, VEL_CUTOFF
+        ))
+
+    def extend(self, other):
+        """
+        Appends the samples of a later buffer of the same topic.
+        """
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.fields = other.fields
+            self.columns = other.columns
+            self.yaws = other.yaws
+        else:
+            self.columns = np.concatenate([self.columns, other.columns], axis=1)
+            self.yaws = np.concatenate([self.yaws, other.yaws])
+        self.n += other.n
+
+    def drop_before(self, time):
+        """
+        Forgets the samples older than `time`.
+        """
+        start = np.searchsorted(self.times, time)
+        self.columns = self.columns[:, start:]
+        self.yaws = self.yaws[start:]
+        self.n -= start
+
+    def select(self, mask):
+        """
+        New buffer with the samples selected by `mask`.
+        """
+        buffer = TfBuffer()
+        buffer.fields = self.fields
+        buffer.columns = self.columns[:, mask]
+        buffer.yaws = self.yaws[mask]
+        buffer.n = buffer.columns.shape[1]
+        return buffer
+
+    def get_indices_at_times(self, times):
+        """
+        Indices of the samples closest to `times` and whether they are within MAX_DT.
+        """
+        return nearest_indices(times, self.times, MAX_DT)
+
+def read_buffers(bag_path, topics):
+    with rosbag.Bag(bag_path) as bag:
+        # preallocated from the message counts in the bag index
+        buffers = {topic: TfBuffer(bag.get_message_count(topic_filters=[topic])) for topic in topics}
+        n = bag.get_message_count(topic_filters=topics)
+        with alive_bar(n) as bar:
+            # only the pose fields are decoded
+            for topic, raw, t in bag.read_messages(topics=topics, raw=True):
+                buffers[topic].append(t.to_sec(), decode_pose(raw))
+                bar()
+    return {topic: buffer.finish() for topic, buffer in buffers.items()}
+
+def iter_buffer_blocks(bag_path, topics, duration):
+    """
+    Like read_buffers, but yields the buffers of consecutive blocks of `duration` seconds of bag time.
+    """
+    buffers = {topic: TfBuffer() for topic in topics}
+    block_end = None
     with rosbag.Bag(bag_path) as bag:
-        n = bag.get_message_count(ODOM_TOPIC)
-        data = []
+        n = bag.get_message_count(topic_filters=topics)
         with alive_bar(n) as bar:
-            last_vx_vicon = 0
-            last_vy_vicon = 0
-            for _, msg, t in bag.read_messages(topics=[ODOM_TOPIC]):
-                vicon_msg = tf_buffer.get_transform_at_time(t.to_sec())
-                vx_vicon = 0
-                vy_vicon = 0
+            for topic, raw, t in bag.read_messages(topics=topics, raw=True):
+                t = t.to_sec()
+                if block_end is None:
+                    block_end = t + duration
+                if t >= block_end:
+                    yield {topic: buffer.finish() for topic, buffer in buffers.items()}
+                    buffers = {topic: TfBuffer() for topic in topics}
+                    while t >= block_end:
+                        block_end += duration
+                buffers[topic].append(t, decode_pose(raw))
                 bar()
+    yield {topic: buffer.finish() for topic, buffer in buffers.items()}
+
+def read_offset_windows(bag_path, odom_topic, gt_topic):
+    """
+    Buffers of the odom and ground truth in windows spread evenly over the bag, see OFFSET_WINDOWS.
+    Every window is read by seeking, so the whole bag is never read, and holds MAX_OFFSET seconds
+    more ground truth than odom on both sides.
+    Returns:
+        odom_windows, gt_windows: lists of buffers, one per window
+    """
+    odom_windows, gt_windows = [], []
+    with rosbag.Bag(bag_path) as bag:
+        start, end = bag.get_start_time(), bag.get_end_time()
+        duration = OFFSET_SAMPLES * OFFSET_DT
+        if end - start <= duration:
+            windows = [(start, end)]
+        else:
+            stride = (end - start) / OFFSET_WINDOWS
+            windows = [(start + i * stride, start + i * stride + duration / OFFSET_WINDOWS) for i in range(OFFSET_WINDOWS)]
+        for window_start, window_end in windows:
+            buffers = {odom_topic: TfBuffer(), gt_topic: TfBuffer()}
+            messages = bag.read_messages(
+                topics=[odom_topic, gt_topic],
+                start_time=genpy.Time.from_sec(max(window_start - MAX_OFFSET, 0.0)),
+                end_time=genpy.Time.from_sec(window_end + MAX_OFFSET),
+                raw=True
+            )
+            for topic, raw, t in messages:
+                buffers[topic].append(t.to_sec(), decode_pose(raw))
+            odom = buffers[odom_topic].finish()
+            odom_windows.append(odom.select((odom.times >= window_start) & (odom.times <= window_end)))
+            gt_windows.append(buffers[gt_topic].finish())
+    return odom_windows, gt_windows
+
+def decimation_mask(times, dt):
+    """
+    Mask of the first sample in every `dt` long bin of time.
+    """
+    bins = np.floor(times / dt)
+    return bins > np.maximum.accumulate(np.concatenate([[-np.inf], bins[:-1]]))
+
+def decode_pose(raw):
+    if not raw_decode.can_decode(raw[0]):
+        raise ValueError("Unsupported message type for evaluation: ", raw[0])
+    return raw_decode.decode(raw)
+
+def motion_signals(times, xy, yaw):
+    """
+    Speed and yaw rate, which do not depend on the frame of the trajectory.
+    Samples without a valid time step are NaN.
+    """
+    dt = np.gradient(times)
+    dt[dt <= 0] = np.nan
+    speed = np.hypot(np.gradient(xy[:, 0]), np.gradient(xy[:, 1])) / dt
+    yaw_rate = np.gradient(np.unwrap(yaw)) / dt
+    return np.stack([speed, yaw_rate], axis=1)
 
-                if vicon_msg is  None or tf_buffer.curr_index == 0:
-                    print('No vicon data at time: ', t.to_sec())
-                    continue
-
-                if not init and NORMALIZE:
-                    x_init = msg.pose.position.x
-                    y_init = msg.pose.position.y
-                    yaw_init = get_yaw(msg)
-                    vicon_x_init = vicon_msg.transform.translation.x if 'vicon' in VICON_TOPIC else vicon_msg.pose.position.x
-                    vicon_y_init = vicon_msg.transform.translation.y if 'vicon' in VICON_TOPIC else vicon_msg.pose.position.y
-                    vicon_yaw_init = get_yaw(vicon_msg, 'vicon' in VICON_TOPIC)
-                    init = True
-                # compute mean squared error
-                last_vicon_msg = tf_buffer.buffer[tf_buffer.curr_index - 1][0]
-                dt = vicon_msg.header.stamp.to_sec() - last_vicon_msg.header.stamp.to_sec()
-
-                pos_x = msg.pose.position.x - x_init
-                pos_y = msg.pose.position.y - y_init
-                vy = 0
-                yaw = get_yaw(msg) - yaw_init
-
-                if 'vicon' in VICON_TOPIC:
-                    vicon_pos_x = vicon_msg.transform.translation.x - vicon_x_init
-                    vicon_pos_y = vicon_msg.transform.translation.y - vicon_y_init
-                    vicon_yaw = get_yaw(vicon_msg, True) - vicon_yaw_init
-                    vx_glob_vicon = (vicon_msg.transform.translation.x - last_vicon_msg.transform.translation.x) / dt
-                    vy_glob_vicon = (vicon_msg.transform.translation.y - last_vicon_msg.transform.translation.y) / dt
-                    last_vicon_yaw = get_yaw(last_vicon_msg, True) - vicon_yaw_init
-                    if last_vicon_yaw - vicon_yaw > math.pi:
-                        vicon_yaw += 2 * math.pi
-                    vyaw_vicon = (vicon_yaw - last_vicon_yaw) / dt
-                    vx_vicon = vx_glob_vicon * math.cos(vicon_yaw) + vy_glob_vicon * math.sin(vicon_yaw)
-                    vy_vicon = -vx_glob_vicon * math.sin(vicon_yaw) + vy_glob_vicon * math.cos(vicon_yaw)
-                    vx_vicon = VEL_ALPHA * vx_vicon + (1 - VEL_ALPHA) * last_vx_vicon
-                    vy_vicon = VEL_ALPHA * vy_vicon + (1 - VEL_ALPHA) * last_vy_vicon
-                else:
-                    vicon_yaw = get_yaw(vicon_msg) - vicon_yaw_init
-                    vicon_pos_x = vicon_msg.pose.position.x - vicon_x_init
-                    vicon_pos_y = vicon_msg.pose.position.y  - vicon_y_init
-                    # vx_vicon = vicon_msg.twist.twist.linear.x
-                    # vy_vicon = vicon_msg.twist.twist.linear.y
-                    # vyaw_vicon = vicon_msg.twist.twist.angular.z
-
-                    last_vx_vicon = vx_vicon
-                    last_vy_vicon = vy_vicon
-
-                error_x += (vicon_pos_x - pos_x)**2
-                error_y += (vicon_pos_y - pos_y)**2
-                error_yaw += (vicon_yaw - yaw)**2
-                # error_vx += (vx_vicon - msg.twist.twist.linear.x)**2
-                # error_vy += (vy_vicon - vy)**2
-                # error_vyaw = (vyaw_vicon - msg.twist.twist.angular.z)**2
-                    # add to dataframe
-                if PLOT:
-                    data.append({
-                        "time": t.to_sec(),
-                        "position_x": pos_x,
-                        "vicon_position_x": vicon_pos_x,
-                        "position_y": pos_y,
-                        "vicon_position_y": vicon_pos_y,
-                        # "velocity_x": msg.twist.twist.linear.x,
-                        # "vicon_velocity_x": vx_vicon,
-                        # "velocity_y": vy,
-                        # "vicon_velocity_y": vy_vicon,
-                        "yaw": yaw, 
-                        # "vicon_yaw": vicon_yaw,
-                        # "vicon_vyaw": vyaw_vicon,
-                        # "vyaw": msg.twist.twist.angular.z,
-                    })
-                last_vicon_msg = vicon_msg
-                i+=1
-    error_x = int(math.sqrt(error_x/i) * 10000) / 10000
-    error_y = int(math.sqrt(error_y/i) * 10000) / 10000
-    error_yaw = int(math.sqrt(error_yaw/i) * 10000) / 10000
-    error_vx = int(math.sqrt(error_vx/i) * 10000) / 10000
-    error_vy = int(math.sqrt(error_vy/i) * 10000) / 10000
-    error_vyaw = int(math.sqrt(error_vyaw/i) * 10000) / 10000
+def truncate(value):
+    return int(value * 10000) / 10000
+
+def rmse(error):
+    return truncate(math.sqrt(np.mean(error**2)))
+
+def offset_signals(buffers):
+    """
+    Times and motion signals of the buffers decimated to OFFSET_DT, concatenated. The signals are
+    differentiated per buffer, so they do not span the gaps between windows.
+    """
+    times, signals = [np.zeros(0)], [np.zeros((0, 2))]
+    for buffer in buffers:
+        buffer = buffer.select(decimation_mask(buffer.times, OFFSET_DT))
+        if buffer.n < 2:
+            continue
+        times.append(buffer.times)
+        signals.append(motion_signals(buffer.times, buffer.xy, buffer.yaws))
+    return np.concatenate(times), np.concatenate(signals)
+
+def estimate_offset(odom_windows, gt_windows):
+    """
+    Odom latency, 0 if the recordings are too short to estimate it. Both series are decimated
+    to OFFSET_DT, so that their motion signals are differentiated at the same rate.
+    """
+    try:
+        return estimate_time_offset(*offset_signals(odom_windows), *offset_signals(gt_windows), MAX_OFFSET)
+    except ValueError as e:
+        print('Warning: cannot estimate the odom latency, assuming 0: ', e)
+        return 0.0
+
+def match_ground_truth(odom_times, tf_buffer):
+    """
+    Ground truth positions, yaws and velocities at the odom times.
+    Returns:
+        valid, vicon_xyz, vicon_yaw, vicon_velocities, only for the valid odom samples
+    """
+    global overall_dt
+    vicon_velocities = tf_buffer.get_velocities()
+    if INTERPOLATE:
+        # resample the ground truth at the odom timestamps
+        positions, valid = interpolate_linear(odom_times, tf_buffer.times, tf_buffer.xyz, MAX_DT)
+        quaternions, _ = slerp(odom_times, tf_buffer.times, tf_buffer.quaternions, MAX_DT)
+        vicon_velocities, _ = interpolate_linear(odom_times, tf_buffer.times, vicon_velocities, MAX_DT)
+        vicon_xyz = positions[valid]
+        vicon_yaw = quaternions_to_yaw(quaternions[valid])
+        vicon_velocities = vicon_velocities[valid]
+        # distance to the closer of the two enclosing ground truth samples
+        indices, _ = tf_buffer.get_indices_at_times(odom_times[valid])
+        overall_dt += np.sum(np.abs(tf_buffer.times[indices] - odom_times[valid]))
+    else:
+        # match every odom sample to the closest ground truth sample in one pass
+        indices, valid = tf_buffer.get_indices_at_times(odom_times)
+        valid &= indices > 0
+        indices = indices[valid]
+        overall_dt += np.sum(np.abs(tf_buffer.times[indices] - odom_times[valid]))
+        vicon_xyz = tf_buffer.xyz[indices]
+        vicon_yaw = tf_buffer.yaws[indices]
+        vicon_velocities = vicon_velocities[indices]
+    return valid, vicon_xyz, vicon_yaw, vicon_velocities
+
+def evaluate_bag(bag_path):
+    buffers = read_buffers(bag_path, [ODOM_TOPIC, VICON_TOPIC])
+    odom = buffers[ODOM_TOPIC]
+    tf_buffer = buffers[VICON_TOPIC]
+
+    offset = 0.0
+    if ESTIMATE_OFFSET:
+        offset = estimate_offset([odom], [tf_buffer])
+        print('Estimated odom latency [s]: ', offset)
+    odom_times = odom.times - offset
+
+    valid, vicon_xyz, vicon_yaw, vicon_velocities = match_ground_truth(odom_times, tf_buffer)
+    if not np.all(valid):
+        print('No vicon data for ', np.count_nonzero(~valid), ' samples')
+    i = np.count_nonzero(valid)
+    if i == 0:
+        raise ValueError("No matching vicon data in bag: ", bag_path)
+
+    times = odom_times[valid]
+    xyz = odom.xyz[valid]
+    yaw = odom.yaws[valid]
+    velocities = odom.get_velocities()[valid]
+
+    # trajectory errors, independent of NORMALIZE
+    ate = absolute_trajectory_error(xyz, yaw, vicon_xyz, vicon_yaw, ALIGNMENT)
+    rpe = relative_pose_error(times, xyz, yaw, vicon_xyz, vicon_yaw, RPE_DELTA, RPE_UNIT)
+    print('ATE translation: ', error_statistics(ate["translation"]))
+    print('ATE yaw: ', error_statistics(ate["yaw"]))
+    print('RPE translation: ', error_statistics(rpe["translation"]))
+    print('RPE yaw: ', error_statistics(rpe["yaw"]))
+
+    pos_x = xyz[:, 0]
+    pos_y = xyz[:, 1]
+    vicon_pos_x = vicon_xyz[:, 0]
+    vicon_pos_y = vicon_xyz[:, 1]
+    if NORMALIZE:
+        pos_x = pos_x - pos_x[0]
+        pos_y = pos_y - pos_y[0]
+        yaw = yaw - yaw[0]
+        vicon_pos_x = vicon_pos_x - vicon_pos_x[0]
+        vicon_pos_y = vicon_pos_y - vicon_pos_y[0]
+        vicon_yaw = vicon_yaw - vicon_yaw[0]
+
+    error_x = rmse(vicon_pos_x - pos_x)
+    error_y = rmse(vicon_pos_y - pos_y)
+    error_yaw = rmse(wrap_angle(vicon_yaw - yaw))
+    error_vx = rmse(vicon_velocities[:, 0] - velocities[:, 0])
+    error_vy = rmse(vicon_velocities[:, 1] - velocities[:, 1])
+    error_vyaw = rmse(vicon_velocities[:, 2] - velocities[:, 2])
     print('Mean Squared Error in x: ', error_x)
     print('Mean Squared Error in y: ', error_y)
     print('Mean Squared Error in vx: ', error_vx)
@@ -180,7 +384,139 @@ def evaluate_bag(bag_path):
     print('Mean Squared Error in yaw: ', error_yaw)
     print('Mean Squared Error in angular velocity: ', error_vyaw)
     print('Number of samples: ', i)
-    return  pd.DataFrame(data), [error_x, error_y, error_vx, error_vy, error_yaw, error_vyaw]
+
+    data = []
+    if PLOT:
+        data = {
+            "time": times,
+            "position_x": pos_x,
+            "vicon_position_x": vicon_pos_x,
+            "position_y": pos_y,
+            "vicon_position_y": vicon_pos_y,
+            "velocity_x": velocities[:, 0],
+            "vicon_velocity_x": vicon_velocities[:, 0],
+            "velocity_y": velocities[:, 1],
+            "vicon_velocity_y": vicon_velocities[:, 1],
+            "yaw": yaw,
+            "vicon_yaw": vicon_yaw,
+            "vicon_vyaw": vicon_velocities[:, 2],
+            "vyaw": velocities[:, 2],
+            "ate_translation": ate["translation"],
+            "ate_yaw": ate["yaw"],
+        }
+    errors = [error_x, error_y, error_vx, error_vy, error_yaw, error_vyaw]
+    errors += [rmse(ate["translation"]), rmse(ate["yaw"]), rmse(rpe["translation"]), rmse(rpe["yaw"])]
+    errors += [offset]
+    return  pd.DataFrame(data), errors
+
+
+def evaluate_bag_streaming(bag_path):
+    """
+    Evaluates the bag in blocks of STREAM_BLOCK seconds, holding only the current block and a
+    margin of MAX_DT + VEL_WINDOW around it. The errors are accumulated in constant memory
+    and match evaluate_bag, except for the medians, which come from quantile sketches, and the
+    latency, which is estimated beforehand on windows of the run, see OFFSET_WINDOWS. Memory
+    is bounded by the block and window sizes, not by the length of the run.
+    """
+    margin = MAX_DT + VEL_WINDOW
+    accumulators = {key: ErrorAccumulator() for key in ["x", "y", "vx", "vy", "yaw", "vyaw", "rpe_translation", "rpe_yaw"]}
+    ate = AteAccumulator(ALIGNMENT)
+    odom = tf_buffer = reference = rpe_tail = None
+    state = {"start": -np.inf, "missing": 0}
+
+    offset = 0.0
+    if ESTIMATE_OFFSET:
+        offset = estimate_offset(*read_offset_windows(bag_path, ODOM_TOPIC, VICON_TOPIC))
+        print('Estimated odom latency [s]: ', offset)
+
+    def evaluate_until(end):
+        nonlocal reference, rpe_tail
+        odom_times = odom.times - offset
+        selected = (odom_times > state["start"]) & (odom_times <= end)
+        state["start"] = end
+        if not np.any(selected) or len(tf_buffer.times) == 0:
+            state["missing"] += np.count_nonzero(selected)
+            return
+        valid, vicon_xyz, vicon_yaw, vicon_velocities = match_ground_truth(odom_times[selected], tf_buffer)
+        state["missing"] += np.count_nonzero(~valid)
+        if not np.any(valid):
+            return
+        times = odom_times[selected][valid]
+        xyz = odom.xyz[selected][valid]
+        yaw = odom.yaws[selected][valid]
+        velocities = odom.get_velocities()[selected][valid]
+
+        ate.update(xyz, yaw, vicon_xyz, vicon_yaw)
+        # windows which did not end yet are carried over to the next block
+        block = {"times": times, "xyz": xyz, "yaw": yaw, "vicon_xyz": vicon_xyz, "vicon_yaw": vicon_yaw}
+        if rpe_tail is not None:
+            block = {key: np.concatenate([rpe_tail[key], block[key]]) for key in block}
+        rpe = relative_pose_error(block["times"], block["xyz"], block["yaw"], block["vicon_xyz"], block["vicon_yaw"], RPE_DELTA, RPE_UNIT)
+        accumulators["rpe_translation"].update(rpe["translation"])
+        accumulators["rpe_yaw"].update(rpe["yaw"])
+        rpe_tail = {key: value[len(rpe["index"]):] for key, value in block.items()}
+
+        if reference is None:
+            reference = np.array([xyz[0, 0], xyz[0, 1], yaw[0], vicon_xyz[0, 0], vicon_xyz[0, 1], vicon_yaw[0]])
+        if not NORMALIZE:
+            reference = np.zeros(6)
+        accumulators["x"].update((vicon_xyz[:, 0] - reference[3]) - (xyz[:, 0] - reference[0]))
+        accumulators["y"].update((vicon_xyz[:, 1] - reference[4]) - (xyz[:, 1] - reference[1]))
+        accumulators["yaw"].update(wrap_angle((vicon_yaw - reference[5]) - (yaw - reference[2])))
+        accumulators["vx"].update(vicon_velocities[:, 0] - velocities[:, 0])
+        accumulators["vy"].update(vicon_velocities[:, 1] - velocities[:, 1])
+        accumulators["vyaw"].update(vicon_velocities[:, 2] - velocities[:, 2])
+
+    for buffers in iter_buffer_blocks(bag_path, [ODOM_TOPIC, VICON_TOPIC], STREAM_BLOCK):
+        if odom is None:
+            odom = buffers[ODOM_TOPIC]
+            tf_buffer = buffers[VICON_TOPIC]
+        else:
+            odom.extend(buffers[ODOM_TOPIC])
+            tf_buffer.extend(buffers[VICON_TOPIC])
+        if len(odom.times) == 0 or len(tf_buffer.times) == 0:
+            continue
+        # later samples may still get a ground truth sample or velocity window from the next block
+        end = min(odom.times[-1] - offset, tf_buffer.times[-1]) - margin
+        if end > state["start"]:
+            evaluate_until(end)
+            odom.drop_before(end + offset - margin)
+            tf_buffer.drop_before(end - margin)
+    if odom is not None:
+        evaluate_until(np.inf)
+
+    i = accumulators["x"].stats.n
+    if state["missing"] > 0:
+        print('No vicon data for ', state["missing"], ' samples')
+    if i == 0:
+        raise ValueError("No matching vicon data in bag: ", bag_path)
+    ate_translation, ate_yaw = ate.rmse()
+    print('ATE translation RMSE: ', ate_translation)
+    print('ATE yaw RMSE: ', ate_yaw)
+    print('RPE translation: ', accumulators["rpe_translation"].statistics())
+    print('RPE yaw: ', accumulators["rpe_yaw"].statistics())
+    errors = [truncate(accumulators[key].stats.rms) for key in ["x", "y", "vx", "vy", "yaw", "vyaw"]]
+    print('Mean Squared Error in x: ', errors[0])
+    print('Mean Squared Error in y: ', errors[1])
+    print('Mean Squared Error in vx: ', errors[2])
+    print('Mean Squared Error in vy: ', errors[3])
+    print('Mean Squared Error in yaw: ', errors[4])
+    print('Mean Squared Error in angular velocity: ', errors[5])
+    print('Number of samples: ', i)
+    errors += [truncate(ate_translation), truncate(ate_yaw)]
+    errors += [truncate(accumulators["rpe_translation"].stats.rms), truncate(accumulators["rpe_yaw"].stats.rms)]
+    errors += [offset]
+    return pd.DataFrame([]), errors
+
+
+def evaluate(bag_name):
+    global overall_dt
+    # runs in a worker process, so overall_dt is returned per bag
+    overall_dt = 0
+    print('Evaluating: ', bag_name)
+    evaluate_fn = evaluate_bag_streaming if STREAM else evaluate_bag
+    data, errors = evaluate_fn(os.path.join(PATH_ROOT, bag_name))
+    return data, errors, overall_dt
 
 
 def plot_data(df, path, title, x_label, y_label, col_bag, col_vicon, y_lim=None):
@@ -209,6 +545,11 @@ def write_errors(errors, path):
         f.write('Mean Squared Error in vy: ' + str(errors[3]) + '\n')
         f.write('Mean Squared Error in yaw: ' + str(errors[4]) + '\n')
         f.write('Mean Squared Error in angular velocity: ' + str(errors[5]) + '\n')
+        f.write(f'ATE ({ALIGNMENT} aligned) translation RMSE: ' + str(errors[6]) + '\n')
+        f.write(f'ATE ({ALIGNMENT} aligned) yaw RMSE: ' + str(errors[7]) + '\n')
+        f.write(f'RPE ({RPE_DELTA} {RPE_UNIT}) translation RMSE: ' + str(errors[8]) + '\n')
+        f.write(f'RPE ({RPE_DELTA} {RPE_UNIT}) yaw RMSE: ' + str(errors[9]) + '\n')
+        f.write('Estimated odom latency [s]: ' + str(errors[10]) + '\n')
         f.close()
 
 def main():
@@ -224,14 +565,14 @@ def main():
                 return
     os.mkdir(dirpath)
 
-    data = []
-    for bag_name in BAGS:
+    results = map_bags(evaluate, BAGS, WORKERS)
+    total_dt = 0
+    for bag_name, (data, errors, bag_dt) in zip(BAGS, results):
+        total_dt += bag_dt
         bagdir = os.path.join(dirpath, bag_name.replace('.bag', ''))
         if os.path.exists(bagdir) and os.path.isdir(bagdir):
             shutil.rmtree(bagdir)
         os.mkdir(bagdir)
-        print('Evaluating: ', bag_name)
-        data, errors = evaluate_bag(os.path.join(PATH_ROOT, bag_name))
         write_errors(errors, os.path.join(bagdir, "errors.txt"))
 
         camera  = "without camera" if "no" in bag_name else "with camera"
@@ -246,13 +587,13 @@ def main():
         if PLOT:
             plot_data(data, os.path.join(bagdir, f"{bag_name.replace('.bag', '')}_positionx.pdf"), f"position x [m], {title}, RMSE = {errors[0]}", 'Time [s]', 'x [m]', "position_x", "vicon_position_x")
             plot_data(data, os.path.join(bagdir, f"{bag_name.replace('.bag', '')}_positiony.pdf"), f"position y [m], {title}, RMSE = {errors[1]}", 'Time [s]', 'y [m]', "position_y", "vicon_position_y")
-            # plot_data(data, os.path.join(bagdir, f"{bag_name.replace('.bag', '')}_velocityx.pdf"), f"velocity x [m/s], {title}, RMSE = {errors[2]}", 'Time [s]', 'vx [m/s]', "velocity_x", "vicon_velocity_x")
-            # plot_data(data, os.path.join(bagdir, f"{bag_name.replace('.bag', '')}_velocityy.pdf"), f"velocity y [m/s], {title}, RMSE = {errors[3]}", 'Time [s]', 'vy [m/s]', "velocity_y", "vicon_velocity_y")
-            # plot_data(data, os.path.join(bagdir, f"{bag_name.replace('.bag', '')}_yaw.pdf"), f"yaw [rad], {title}, RMSE = {errors[4]}", 'Time [s]', 'yaw [rad]', "yaw", "vicon_yaw")
-            # plot_data(data, os.path.join(bagdir, f"{bag_name.replace('.bag', '')}_yawdot.pdf"), f"Angular Velocity [rad], {title}, RMSE = {errors[5]}", 'Time [s]', 'Angular velocity z [rad / s]', "vyaw", "vicon_vyaw")
+            plot_data(data, os.path.join(bagdir, f"{bag_name.replace('.bag', '')}_velocityx.pdf"), f"velocity x [m/s], {title}, RMSE = {errors[2]}", 'Time [s]', 'vx [m/s]', "velocity_x", "vicon_velocity_x")
+            plot_data(data, os.path.join(bagdir, f"{bag_name.replace('.bag', '')}_velocityy.pdf"), f"velocity y [m/s], {title}, RMSE = {errors[3]}", 'Time [s]', 'vy [m/s]', "velocity_y", "vicon_velocity_y")
+            plot_data(data, os.path.join(bagdir, f"{bag_name.replace('.bag', '')}_yaw.pdf"), f"yaw [rad], {title}, RMSE = {errors[4]}", 'Time [s]', 'yaw [rad]', "yaw", "vicon_yaw")
+            plot_data(data, os.path.join(bagdir, f"{bag_name.replace('.bag', '')}_yawdot.pdf"), f"Angular Velocity [rad], {title}, RMSE = {errors[5]}", 'Time [s]', 'Angular velocity z [rad / s]', "vyaw", "vicon_vyaw")
 
         print('')
-    print('Overall dt: ', overall_dt)
+    print('Overall dt: ', total_dt)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from frenet_conversion.frenet_converter import FrenetConverter
+
+
+def resample(x, y, spacing=0.1):
+    # waypoints every `spacing` meters along a densely sampled closed line
+    s = np.concatenate([[0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))])
+    q = np.arange(0.0, s[-1] - spacing / 2, spacing)
+    return np.interp(q, s, x), np.interp(q, s, y)
+
+
+@pytest.fixture(scope="module")
+def converter():
+    t = np.linspace(0.0, 2 * np.pi, 20001)
+    return FrenetConverter(*resample(20 * np.cos(t), 10 * np.sin(t)))
+
+
+def test_non_finite_s_gives_nan(converter):
+    s = np.array([1.0, np.nan, np.inf, -np.inf])
+    with np.errstate(all="raise"):
+        x, y = converter.get_cartesian(s, np.zeros(4))
+        psi = converter.get_heading(s)
+    assert np.all(np.isfinite([x[0], y[0], psi[0]]))
+    assert np.all(np.isnan(x[1:])) and np.all(np.isnan(y[1:])) and np.all(np.isnan(psi[1:]))
+
+
+def test_sequence_stays_on_hairpin_straight():
+    # straights 1.2 m apart joined by half circles, samples drift towards the other straight
+    radius, length = 0.6, 20.0
+    turn = np.linspace(-np.pi / 2, np.pi / 2, 2001)[:-1]
+    straight = np.linspace(0.0, length, 4001)[:-1]
+    x = np.concatenate([straight, length + radius * np.cos(turn), length - straight, -radius * np.cos(turn)])
+    y = np.concatenate([np.zeros(4000), radius + radius * np.sin(turn), np.full(4000, 2 * radius), radius - radius * np.sin(turn)])
+    converter = FrenetConverter(*resample(x, y))
+
+    s = np.linspace(2.0, 18.0, 20000)
+    d = 0.3 + 0.5 * np.sin(np.pi * (s - 2.0) / 16.0)
+    x, y = converter.get_cartesian(s, d)
+    # past half the gap, the nearest waypoint is on the other straight
+    assert not np.allclose(converter.get_frenet(x, y), [s, d], atol=1e-2)
+    np.testing.assert_allclose(converter.get_frenet_sequence(x, y), [s, d], atol=1e-2)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from utils.time_alignment import estimate_time_offset
+
+
+def motion(times):
+    # speed and yaw rate of a car accelerating out of corners
+    speed = 5 + 2 * np.sin(0.7 * times) + np.sin(1.9 * times + 0.3)
+    yaw_rate = 0.8 * np.cos(1.3 * times) + 0.2 * np.sin(3.1 * times)
+    return np.stack([speed, yaw_rate], axis=1)
+
+
+@pytest.mark.parametrize("duration", [5.0, 30.0, 200.0])
+@pytest.mark.parametrize("offset", [0.05, -0.2, 0.45])
+def test_estimate_time_offset_recovers_injected_offset(duration, offset):
+    gt_times = np.arange(0, duration, 0.01)
+    est_times = np.arange(0.003, duration, 0.02)
+    estimate = estimate_time_offset(est_times, motion(est_times - offset), gt_times, motion(gt_times), max_offset=0.5)
+    assert estimate == pytest.approx(offset, abs=2e-3)
+
+
+def test_estimate_time_offset_rejects_short_overlap():
+    times = np.arange(0, 0.8, 0.01)
+    with pytest.raises(ValueError):
+        estimate_time_offset(times, motion(times), times, motion(times), max_offset=0.5)